@@ -0,0 +1,199 @@
+import numpy as np
+
+# Capacity-constrained assignment of target cells to tiles, see PLACEMENT in mosaic.py
+
+SPARE_OWNER = -2
+
+def get_candidate_edges(cells, tiles, cell_candidates, tile_candidates=4, required_tiles=None, required_costs=None, block_size=512):
+    # sparse cell x tile cost graph with the cell_candidates cheapest tiles of every cell, plus the tile_candidates
+    # cheapest cells of every tile so that every tile can still be placed somewhere, plus an optional required tile
+    # per cell (-1 for none). Returns (offsets, tile indexes, costs) with the edges of cell i at offsets[i]:offsets[i + 1]
+    num_cells, num_tiles = len(cells), len(tiles)
+    cell_candidates = min(cell_candidates, num_tiles)
+    tile_candidates = min(tile_candidates, num_cells)
+    tiles_sq_norms = np.einsum('ij,ij->i', tiles, tiles)
+    edge_cells, edge_tiles, edge_costs = [], [], []
+    best_cells = np.zeros((0, num_tiles), dtype=np.int64)
+    best_costs = np.zeros((0, num_tiles))
+    for start in range(0, num_cells, block_size):
+        block = cells[start:start + block_size]
+        costs = np.einsum('ij,ij->i', block, block)[:, None] - 2 * (block @ tiles.T) + tiles_sq_norms[None, :]
+        top = np.argpartition(costs, cell_candidates - 1, axis=1)[:, :cell_candidates]
+        edge_cells.append(np.repeat(np.arange(start, start + len(block)), cell_candidates))
+        edge_tiles.append(top.ravel())
+        edge_costs.append(np.take_along_axis(costs, top, axis=1).ravel())
+        # keep the running tile_candidates cheapest cells of every tile
+        rows = np.argpartition(costs, min(tile_candidates, len(block)) - 1, axis=0)[:tile_candidates]
+        best_cells = np.concatenate([best_cells, rows + start])
+        best_costs = np.concatenate([best_costs, np.take_along_axis(costs, rows, axis=0)])
+        if len(best_cells) > tile_candidates:
+            keep = np.argpartition(best_costs, tile_candidates - 1, axis=0)[:tile_candidates]
+            best_cells = np.take_along_axis(best_cells, keep, axis=0)
+            best_costs = np.take_along_axis(best_costs, keep, axis=0)
+    edge_cells.append(best_cells.ravel())
+    edge_tiles.append(np.tile(np.arange(num_tiles), len(best_cells)))
+    edge_costs.append(best_costs.ravel())
+    if required_tiles is not None:
+        required = np.flatnonzero(required_tiles >= 0)
+        edge_cells.append(required)
+        edge_tiles.append(required_tiles[required])
+        edge_costs.append(required_costs[required])
+
+    edge_cells = np.concatenate(edge_cells)
+    edge_tiles = np.concatenate(edge_tiles)
+    edge_costs = np.concatenate(edge_costs)
+    # drop the edges picked more than once, np.unique also sorts them by cell
+    _, unique_edges = np.unique(edge_cells * num_tiles + edge_tiles, return_index=True)
+    offsets = np.searchsorted(edge_cells[unique_edges], np.arange(num_cells + 1))
+    # the expanded form can come out slightly negative for identical images
+    return (offsets, edge_tiles[unique_edges], np.maximum(edge_costs[unique_edges], 0))
+
+class TileAuction:
+    # Auction algorithm over tile slots: every tile has capacity slots, or as many as it has edges if that is fewer,
+    # and all but the first cost repeat_penalty extra. Every cell also has a fallback slot of its own that costs fallback_cost, for when all its edges are
+    # taken. The slots no cell ends up in are held by a "spare" bidder that values everything at 0. That keeps the
+    # problem square, so epsilon scaling works and the result is within (cells + slots) * epsilon of the cheapest
+    # assignment over the given edges. Unassigned cells bid in parallel (Jacobi bidding)
+    def __init__(self, offsets, edge_tiles, edge_costs, num_tiles, capacity, repeat_penalty=0.0, fallback_cost=None):
+        self.offsets = offsets
+        self.edge_tiles = edge_tiles
+        self.edge_costs = edge_costs
+        self.num_cells = len(offsets) - 1
+        self.num_tiles = num_tiles
+        self.capacity = capacity
+        # a tile is never placed in more cells than it has edges to. Without the cap the spare bidder has to win
+        # every unused slot of every tile, which with REPEAT = 'OK' is most of num_tiles * capacity. The slots of a
+        # tile are consecutive
+        tile_capacities = np.minimum(np.bincount(edge_tiles, minlength=num_tiles), capacity)
+        self.num_slots = int(tile_capacities.sum())
+        self.first_slots = np.cumsum(tile_capacities) - tile_capacities
+        self.slot_tiles = np.repeat(np.arange(num_tiles), tile_capacities)
+        self.slot_penalties = np.where(np.arange(self.num_slots) > self.first_slots[self.slot_tiles], float(repeat_penalty), 0.0)
+        self.tile_capacities = tile_capacities
+        self.cost_range = float(edge_costs.max() - edge_costs.min()) + repeat_penalty
+        if fallback_cost is None:
+            fallback_cost = float(edge_costs.max()) + repeat_penalty + self.cost_range + 1
+        self.fallback_cost = fallback_cost
+        # tile slots first, then the fallback slots of the cells
+        self.prices = np.zeros(self.num_slots + self.num_cells)
+        self.owners = np.full(self.num_slots + self.num_cells, -1)
+        self.cell_slots = np.full(self.num_cells, -1)
+        # the cheapest two slots of every tile, kept up to date as prices change. Tiles without edges have no slots
+        self.cheapest_slots = np.zeros(num_tiles, dtype=np.int64)
+        self.first_prices = np.full(num_tiles, np.inf)
+        self.second_prices = np.full(num_tiles, np.inf)
+        self.update_tile_prices(np.flatnonzero(tile_capacities))
+        self.rounds = 0
+
+    def update_tile_prices(self, tiles):
+        if not len(tiles):
+            return
+        # the slots of the tiles as one flat array of segments, like the edges in get_cell_bids
+        lengths = self.tile_capacities[tiles]
+        segment_starts = np.cumsum(lengths) - lengths
+        slots = np.repeat(self.first_slots[tiles] - segment_starts, lengths) + np.arange(lengths.sum())
+        effective_prices = self.prices[slots] + self.slot_penalties[slots]
+        first_prices = np.minimum.reduceat(effective_prices, segment_starts)
+        segments = np.repeat(np.arange(len(tiles)), lengths)
+        cheapest_positions = np.flatnonzero(effective_prices == first_prices[segments])
+        _, first_cheapest = np.unique(segments[cheapest_positions], return_index=True)
+        cheapest_positions = cheapest_positions[first_cheapest]
+        self.cheapest_slots[tiles] = slots[cheapest_positions]
+        self.first_prices[tiles] = first_prices
+        effective_prices[cheapest_positions] = np.inf
+        self.second_prices[tiles] = np.minimum.reduceat(effective_prices, segment_starts)
+
+    def get_cell_bids(self, cells, epsilon):
+        # every cell bids for the cheapest slot of its most valuable tile (or for its fallback slot), raising the
+        # price to where that slot is only epsilon better than the runner-up. Returns (slots, bids)
+        # gather the edges of all the cells into one flat array of segments
+        lengths = self.offsets[cells + 1] - self.offsets[cells]
+        segment_starts = np.cumsum(lengths) - lengths
+        edges = np.repeat(self.offsets[cells] - segment_starts, lengths) + np.arange(segment_starts[-1] + lengths[-1])
+        segments = np.repeat(np.arange(len(cells)), lengths)
+        tiles = self.edge_tiles[edges]
+        values = -self.edge_costs[edges] - self.first_prices[tiles]
+        best_values = np.maximum.reduceat(values, segment_starts)
+        best_positions = np.flatnonzero(values == best_values[segments])
+        _, first_best = np.unique(segments[best_positions], return_index=True)
+        best_edges = best_positions[first_best]
+        values[best_edges] = -np.inf
+        best_tiles = tiles[best_edges]
+        # the runner-up can also be the next slot of the same tile
+        second_values = np.maximum(np.maximum.reduceat(values, segment_starts), -self.edge_costs[edges[best_edges]] - self.second_prices[best_tiles])
+        best_slots = self.cheapest_slots[best_tiles]
+
+        fallback_slots = self.num_slots + cells
+        fallback_values = -self.fallback_cost - self.prices[fallback_slots]
+        to_fallback = fallback_values >= best_values
+        slots = np.where(to_fallback, fallback_slots, best_slots)
+        second_values = np.where(to_fallback, best_values, np.maximum(second_values, fallback_values))
+        best_values = np.maximum(best_values, fallback_values)
+        return (slots, self.prices[slots] + best_values - second_values + epsilon)
+
+    def get_spare_bids(self, wanted, epsilon):
+        # the spare bidder wants the cheapest slots it doesn't hold yet, at just over the price of the next one
+        free_slots = np.flatnonzero(self.owners != SPARE_OWNER)
+        cheapest = np.argpartition(self.prices[free_slots], wanted)
+        slots = free_slots[cheapest[:wanted]]
+        return (slots, np.maximum(self.prices[free_slots[cheapest[wanted]]], self.prices[slots]) + epsilon)
+
+    def run_phase(self, epsilon, max_rounds=None):
+        # every phase starts over with the prices of the previous one, which is what makes the later phases cheap.
+        # Returns False if it ran out of rounds
+        self.owners.fill(-1)
+        self.cell_slots.fill(-1)
+        unassigned = np.arange(self.num_cells)
+        spare_held = 0
+        while len(unassigned) or spare_held < self.num_slots:
+            if max_rounds is not None and self.rounds >= max_rounds:
+                return False
+            self.rounds += 1
+            bid_cells = unassigned
+            bid_slots, bids = self.get_cell_bids(unassigned, epsilon) if len(unassigned) else (unassigned, np.zeros(0))
+            if spare_held < self.num_slots:
+                spare_slots, spare_bids = self.get_spare_bids(self.num_slots - spare_held, epsilon)
+                bid_cells = np.concatenate((bid_cells, np.full(len(spare_slots), SPARE_OWNER)))
+                bid_slots = np.concatenate((bid_slots, spare_slots))
+                bids = np.concatenate((bids, spare_bids))
+
+            # the highest bid for every slot wins it and pushes out the previous owner
+            order = np.lexsort((-bids, bid_slots))
+            bid_cells, bid_slots, bids = bid_cells[order], bid_slots[order], bids[order]
+            winners = np.ones(len(bid_slots), dtype=bool)
+            winners[1:] = bid_slots[1:] != bid_slots[:-1]
+            losers = bid_cells[~winners]
+            bid_cells, bid_slots, bids = bid_cells[winners], bid_slots[winners], bids[winners]
+            previous_owners = self.owners[bid_slots]
+            spare_held += np.count_nonzero(bid_cells == SPARE_OWNER) - np.count_nonzero(previous_owners == SPARE_OWNER)
+            self.owners[bid_slots] = bid_cells
+            self.prices[bid_slots] = bids
+            won = bid_cells >= 0
+            self.cell_slots[bid_cells[won]] = bid_slots[won]
+            self.update_tile_prices(np.unique(self.slot_tiles[bid_slots[bid_slots < self.num_slots]]))
+            unassigned = np.concatenate((previous_owners[previous_owners >= 0], losers[losers >= 0]))
+            self.cell_slots[unassigned] = -1
+        return True
+
+    def solve(self, relative_epsilon=1e-4, epsilon_factor=8, max_rounds=None):
+        # returns the tile index of every cell, -1 for cells left in their fallback slot, or None if the bidding took
+        # more than max_rounds rounds
+        min_epsilon = max(relative_epsilon * float(self.edge_costs.mean()), 1e-9)
+        epsilon = max(self.cost_range / epsilon_factor, min_epsilon)
+        while True:
+            if not self.run_phase(epsilon, max_rounds):
+                return None
+            if epsilon <= min_epsilon:
+                break
+            epsilon = max(epsilon / epsilon_factor, min_epsilon)
+        placed = self.cell_slots < self.num_slots
+        tile_indexes = np.full(self.num_cells, -1)
+        tile_indexes[placed] = self.slot_tiles[self.cell_slots[placed]]
+        return tile_indexes
+
+def get_assignment_errors(cells, tiles, tile_indexes):
+    # sum of squared differences of every cell against its tile, 0 for cells without one
+    placed = tile_indexes >= 0
+    errors = np.zeros(len(cells))
+    errors[placed] = ((cells[placed] - tiles[tile_indexes[placed]]) ** 2).sum(axis=1)
+    return errors
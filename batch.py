@@ -0,0 +1,77 @@
+import argparse
+import json
+import os
+import time
+from multiprocessing import Pool
+import numpy as np
+import mosaic
+
+# Renders every job of a manifest against collections that are loaded once and kept warm in a pool of worker
+# processes, instead of paying the tile ingestion and process startup for every mosaic:
+#   python3 batch.py jobs.json --jobs 4
+# where jobs.json is a list of {"image": "cat.jpg", "slugs": "bitcoin-frogs", "title": "Cat", "output_dir": "out/cat"}
+
+# the collections of the current process by comma separated slugs as (tiles, tile features), and the decoded large
+# tiles of each
+collections = {}
+large_tiles = {}
+
+def read_manifest(path):
+    with open(path) as f:
+        jobs = json.load(f)
+    for job in jobs:
+        if isinstance(job['slugs'], str):
+            job['slugs'] = job['slugs'].split(',')
+        if not os.path.isfile(job['image']):
+            raise ValueError("Unable to find image file '{}'".format(job['image']))
+    return jobs
+
+def load_collection(slug_names):
+    # returns (tiles, tile features)
+    tiles = mosaic.load_tiles(['images/' + slug for slug in slug_names])
+    if tiles is None:
+        raise ValueError("No images found in tiles directory '{}'".format(','.join(slug_names)))
+    # the float64 features the matching works on, so that they aren't computed again for every job
+    return (tiles, mosaic.get_match_features(tiles[1]).astype(np.float64))
+
+def load_collections(slug_lists):
+    # with the fork start method the workers inherit the collections the parent loaded, otherwise every worker
+    # loads them here, from the tile cache
+    for slug_names in slug_lists:
+        key = ','.join(slug_names)
+        if key not in collections:
+            collections[key] = load_collection(slug_names)
+            large_tiles[key] = {}
+
+def render_job(job):
+    start_time = time.time()
+    key = ','.join(job['slugs'])
+    os.makedirs(job['output_dir'], exist_ok=True)
+    image_data = mosaic.TargetImage(job['image'], trusted=True).get_data()
+    with open(job['image'], 'rb') as f:
+        result_cache = mosaic.get_result_cache(f.read(), job['slugs'])
+    tiles, tile_features = collections[key]
+    stats = mosaic.render_mosaic(image_data, tiles, job['title'], job['slugs'], job['output_dir'], large_tiles[key], tile_features=tile_features, result_cache=result_cache)
+    stats['seconds'] = round(time.time() - start_time, 3)
+    return (job, stats)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render every mosaic of a manifest against preloaded collections')
+    parser.add_argument('manifest', help='json list of jobs with image, slugs, title and output_dir')
+    parser.add_argument('--jobs', type=int, default=mosaic.WORKER_COUNT, help='how many mosaics are rendered at once')
+    args = parser.parse_args()
+
+    jobs = read_manifest(args.manifest)
+    slug_lists = sorted(set(tuple(job['slugs']) for job in jobs))
+    load_start_time = time.time()
+    load_collections(slug_lists)
+    print('Loaded {} collections in {:.1f}s'.format(len(slug_lists), time.time() - load_start_time))
+
+    start_time = time.time()
+    results = []
+    with Pool(max(1, min(args.jobs, len(jobs))), initializer=load_collections, initargs=(slug_lists,)) as pool:
+        for job, stats in pool.imap_unordered(render_job, jobs):
+            results.append(stats)
+            print('Rendered {} to {} in {:.1f}s ({}/{})'.format(job['image'], job['output_dir'], stats['seconds'], len(results), len(jobs)))
+    elapsed = time.time() - start_time
+    print('Rendered {} mosaics in {:.1f}s, {:.1f} jobs/minute'.format(len(results), elapsed, 60 * len(results) / max(elapsed, 1e-9)))
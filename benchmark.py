@@ -0,0 +1,253 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+from PIL import Image, ImageDraw, ImageStat
+import mosaic
+from features import get_mean_delta_e
+from util import dash_to_camelcase
+
+# Times every stage of the mosaic pipeline against synthetic collections and appends the results to a json file, so
+# runs can be compared across commits:
+#   python3 benchmark.py --tiles 1000,10000 --output benchmark-results.json
+
+REPEAT_MODES = mosaic.REPEAT_MODES
+
+def get_peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+def make_synthetic_collection(slug, num_tiles, seed=0):
+    # writes num_tiles random square-ish images to images/<slug>/ plus the collections/<slug>/ files generate_html reads.
+    # The images are reused by later runs with the same slug
+    tiles_dir = 'images/' + slug
+    collection_dir = 'collections/' + slug
+    if os.path.isdir(tiles_dir) and len(os.listdir(tiles_dir)) == num_tiles and os.path.isfile(collection_dir + '/colors.js'):
+        return tiles_dir
+    print('Generating {} synthetic tiles in {}...'.format(num_tiles, tiles_dir))
+    os.makedirs(tiles_dir, exist_ok=True)
+    os.makedirs(collection_dir, exist_ok=True)
+    rng = random.Random(seed)
+    ids = []
+    colors = []
+    for i in range(num_tiles):
+        id = '{:064x}i0'.format(rng.getrandbits(256))
+        size = rng.choice((32, 40, 48))
+        img = Image.new('RGB', (size, size + rng.choice((0, 0, 8))), tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(img)
+        for _ in range(4):
+            x, y = rng.randrange(size), rng.randrange(size)
+            draw.ellipse((x, y, x + rng.randrange(4, 20), y + rng.randrange(4, 20)), fill=tuple(rng.randrange(256) for _ in range(3)))
+        img.save(tiles_dir + '/' + id, format='PNG')
+        ids.append(id)
+        colors.append(list(map(int, ImageStat.Stat(img).mean)))
+    order = sorted(range(num_tiles), key=lambda i: ids[i])
+    camelcase_slug = dash_to_camelcase(slug)
+    with open(collection_dir + '/ids1.js', 'w') as f:
+        f.write('const ' + camelcase_slug + 'Ids1=["' + '","'.join(ids[i] for i in order) + '"]')
+    with open(collection_dir + '/colors.js', 'w') as f:
+        f.write('const ' + camelcase_slug + 'Colors = ' + json.dumps([colors[i] for i in order], separators=(",", ":")))
+    with open(collection_dir + '/info.json', 'w') as f:
+        json.dump({'ids1': '0' * 64 + 'i0', 'colors': '1' * 64 + 'i0'}, f)
+    return tiles_dir
+
+def make_synthetic_target(path, width, height, seed=0):
+    if os.path.isfile(path):
+        return path
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    img = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1).astype(np.float64)
+    img += rng.normal(0, 20, img.shape)
+    Image.fromarray(np.clip(img, 0, 255).astype(np.uint8)).save(path, quality=90)
+    return path
+
+def save_large_target(path, width, height):
+    # scaled up from the regular synthetic target, generating this many pixels of noise would take gigabytes
+    Image.open(make_synthetic_target('target-1200x900.jpeg', 1200, 900)).resize((width, height), Image.BICUBIC).save(path, quality=90)
+
+def make_large_target(path, width, height):
+    # generated in another process, the full size image would otherwise be the peak memory of every later stage
+    if os.path.isfile(path):
+        return path
+    process = multiprocessing.get_context('spawn').Process(target=save_large_target, args=(path, width, height))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError('Generating the {}x{} target failed'.format(width, height))
+    return path
+
+class StageTimer:
+    def __init__(self, results):
+        self.results = results
+
+    def run(self, name, function, cells=None):
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        result = function()
+        stage = {
+            'stage': name,
+            'wall_seconds': round(time.perf_counter() - start_wall, 4),
+            'cpu_seconds': round(time.process_time() - start_cpu, 4),
+            'peak_rss_mb': get_peak_rss_mb(),
+        }
+        if cells:
+            stage['cells'] = cells
+            stage['cells_per_second'] = round(cells / max(stage['wall_seconds'], 1e-9), 1)
+        print('{:28} {:8.3f}s{}'.format(name, stage['wall_seconds'], '  {:.0f} cells/s'.format(stage['cells_per_second']) if cells else ''))
+        self.results.append(stage)
+        return result
+
+def match_cells(tiles, cells):
+    tile_paths, tiles_small, file_names, file_sizes, average_colors = tiles
+    tile_fitter = mosaic.TileFitter(tiles_small, file_sizes, None, average_colors)
+    tile_indexes = []
+    for i in range(0, len(cells), mosaic.MATCH_BLOCK_SIZE):
+        tile_indexes += tile_fitter.get_best_fit_tiles(cells[i:i + mosaic.MATCH_BLOCK_SIZE])
+    return tile_indexes
+
+def match_features(tiles, cells):
+    # like match_cells with the current MATCH_FEATURES, including the time to compute the features
+    tile_paths, tiles_small, file_names, file_sizes, average_colors = tiles
+    tile_fitter = mosaic.TileFitter(mosaic.get_match_features(tiles_small).astype(np.float64), file_sizes, None, mosaic.get_match_colors(average_colors))
+    cell_features = mosaic.get_match_features(cells)
+    tile_indexes = []
+    for i in range(0, len(cells), mosaic.MATCH_BLOCK_SIZE):
+        tile_indexes += tile_fitter.get_best_fit_tiles(cell_features[i:i + mosaic.MATCH_BLOCK_SIZE])
+    return tile_indexes
+
+def assemble_jpeg(mosaic_size, tile_paths, cell_boxes, tile_indexes, out_file):
+    mosaic_image = mosaic.MosaicImage(mosaic_size)
+    large_tiles = {}
+    for box, tile_index in zip(cell_boxes, tile_indexes):
+        # cells without a tile stay black, like in write_outputs
+        if tile_index is None:
+            continue
+        if tile_index not in large_tiles:
+            large_tiles[tile_index] = mosaic.load_large_tile(tile_paths[tile_index])
+        mosaic_image.add_tile(large_tiles[tile_index], box)
+    mosaic_image.save(out_file)
+
+def benchmark_large_target(target_size):
+    # runs before the collections, so that the peak memory is the target's own
+    target_path = make_large_target('target-{}x{}.jpeg'.format(*target_size), *target_size)
+    stages = []
+    print('\n{}x{} target ({:.0f} MP)'.format(target_size[0], target_size[1], target_size[0] * target_size[1] / 1e6))
+    StageTimer(stages).run('large target preparation', lambda: mosaic.TargetImage(target_path, trusted=True).get_data())
+    return {'size': list(target_size), 'stages': stages}
+
+def benchmark_collection(num_tiles, modes, feature_modes, target_size):
+    slug = 'bench-{}'.format(num_tiles)
+    tiles_dir = make_synthetic_collection(slug, num_tiles)
+    target_path = make_synthetic_target('target-{}x{}.jpeg'.format(*target_size), *target_size)
+    stages = []
+    timer = StageTimer(stages)
+    print('\n{} tiles, {}x{} grid'.format(num_tiles, mosaic.NUM_TILES_PER_ROW, mosaic.NUM_TILES_PER_ROW))
+
+    mosaic.USE_TILE_CACHE = False
+    timer.run('ingestion', lambda: mosaic.TileProcessor(tiles_dir).get_tiles())
+    mosaic.USE_TILE_CACHE = True
+    mosaic.TileProcessor(tiles_dir).get_tiles()
+    tiles = timer.run('ingestion (cached)', lambda: mosaic.TileProcessor(tiles_dir).get_tiles())
+
+    mosaic_size, original_img_small = timer.run('target preparation', lambda: mosaic.TargetImage(target_path, trusted=True).get_data())
+    x_tile_count = mosaic_size[0] // mosaic.TILE_SIZE
+    y_tile_count = mosaic_size[1] // mosaic.TILE_SIZE
+    cells, cell_boxes = timer.run('cell extraction', lambda: mosaic.get_target_cells(original_img_small, x_tile_count, y_tile_count), x_tile_count * y_tile_count)
+    order = np.random.default_rng(0).permutation(len(cells))
+    cells, cell_boxes = cells[order], cell_boxes[order]
+
+    tile_indexes = None
+    for mode in modes:
+        mosaic.REPEAT = mode
+        # without repeats there can't be more cells than tiles
+        mode_cells = cells[:num_tiles] if mode in ('STRICT_NO', 'MINIMIZED') else cells
+        mode_tile_indexes = timer.run('matching ' + mode, lambda: match_cells(tiles, mode_cells), len(mode_cells))
+        # the jpeg and the html get the placement with the fewest empty cells
+        if len(mode_cells) == len(cells) and (tile_indexes is None or mode_tile_indexes.count(None) <= tile_indexes.count(None)):
+            tile_indexes = mode_tile_indexes
+
+    # quality against time of every kind of match features, as the mean CIELAB difference between the cells and their
+    # tiles at the matching resolution. REPEAT = 'OK' leaves the most room for the features to make a difference
+    mosaic.REPEAT = 'OK'
+    for features in feature_modes:
+        mosaic.configure(MATCH_FEATURES=features)
+        feature_tile_indexes = timer.run('matching features ' + features, lambda: match_features(tiles, cells), len(cells))
+        placed = np.array([tile_index is not None for tile_index in feature_tile_indexes])
+        placed_tile_indexes = np.array([tile_index for tile_index in feature_tile_indexes if tile_index is not None], dtype=np.int64)
+        stages[-1]['mean_delta_e'] = round(get_mean_delta_e(cells[placed], tiles[1][placed_tile_indexes]), 3)
+        print('{:28} mean delta E {:.2f}'.format('', stages[-1]['mean_delta_e']))
+    mosaic.configure(MATCH_FEATURES='rgb')
+
+    if tile_indexes is None:
+        print('Skipped jpeg assembly and html generation, none of the REPEAT modes matched all the cells')
+    else:
+        if None in tile_indexes:
+            print('{} of {} cells are left empty, the tiles can fill no more of them'.format(tile_indexes.count(None), len(cells)))
+        timer.run('jpeg assembly', lambda: assemble_jpeg(mosaic_size, tiles[0], cell_boxes, tile_indexes, 'benchmark-mosaic.jpeg'), len(cells))
+        stages[-1]['empty_cells'] = tile_indexes.count(None)
+        # row by row, like write_outputs orders them
+        ordered_id_nums = np.array([-1 if tile_index is None else tile_index for tile_index in tile_indexes])[np.lexsort((cell_boxes[:, 0], cell_boxes[:, 1]))].tolist()
+        # the page around orderedIdNums is inscribed with every mosaic, so no template may take more bytes than the
+        # img per cell one
+        runtime_budget = mosaic.get_html_runtime_bytes('dom')
+        for template in mosaic.HTML_TEMPLATES:
+            mosaic.configure(HTML_TEMPLATE=template)
+            timer.run('html generation ' + template, lambda: mosaic.generate_html(ordered_id_nums, 'benchmark-mosaic.html', '', 'Benchmark', [slug]))
+            stages[-1]['html_bytes'] = os.path.getsize('benchmark-mosaic.html')
+            stages[-1]['runtime_bytes'] = mosaic.get_html_runtime_bytes(template)
+            stages[-1]['within_budget'] = stages[-1]['runtime_bytes'] <= runtime_budget
+            print('{:28} {} bytes, {} without orderedIdNums{}'.format('', stages[-1]['html_bytes'], stages[-1]['runtime_bytes'],
+                '' if stages[-1]['within_budget'] else ', over the budget of {}'.format(runtime_budget)))
+        mosaic.configure(HTML_TEMPLATE='dom')
+    return {'tiles': num_tiles, 'stages': stages}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the mosaic pipeline against synthetic collections')
+    parser.add_argument('--tiles', default='1000,10000', help='comma separated collection sizes, e.g. 1000,10000,50000')
+    parser.add_argument('--modes', default=','.join(REPEAT_MODES), help='comma separated REPEAT modes to time the matching for')
+    parser.add_argument('--features', default=','.join(mosaic.MATCH_FEATURES_MODES), help='comma separated MATCH_FEATURES to compare quality and time of')
+    parser.add_argument('--target-size', default='1200x900', help='size of the synthetic target image')
+    parser.add_argument('--large-target-size', default='12000x9000', help='size of the high resolution synthetic target, empty to skip it')
+    parser.add_argument('--workdir', default='.benchmark', help='where the synthetic collections are generated and kept between runs')
+    parser.add_argument('--output', default='benchmark-results.json', help='json file the results get appended to')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    os.makedirs(args.workdir, exist_ok=True)
+    os.chdir(args.workdir)
+    run = {
+        'commit': get_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'settings': {
+            'NUM_TILES_PER_ROW': mosaic.NUM_TILES_PER_ROW, 'TILE_SIZE': mosaic.TILE_SIZE, 'TILE_MATCH_RES': mosaic.TILE_MATCH_RES,
+            'MAX_OCCURRENCES_PER_TILE': mosaic.MAX_OCCURRENCES_PER_TILE, 'CANDIDATE_COUNT': mosaic.CANDIDATE_COUNT, 'WORKER_COUNT': mosaic.WORKER_COUNT,
+        },
+        'collections': [],
+    }
+    if args.large_target_size:
+        run['large_target'] = benchmark_large_target(tuple(int(n) for n in args.large_target_size.split('x')))
+    target_size = tuple(int(n) for n in args.target_size.split('x'))
+    for num_tiles in [int(n) for n in args.tiles.split(',')]:
+        run['collections'].append(benchmark_collection(num_tiles, args.modes.split(','), args.features.split(','), target_size))
+
+    runs = []
+    if os.path.isfile(output):
+        with open(output) as f:
+            runs = json.load(f)
+    runs.append(run)
+    with open(output, 'w') as f:
+        json.dump(runs, f, indent=2)
+    print('\nWrote results to', output)
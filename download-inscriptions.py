@@ -1,31 +1,171 @@
 import requests
-import sys
+import urllib3
+import argparse
 import shutil
 import os
-from PIL import Image, ImageOps, ImageStat
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageStat
 import json
 from util import dash_to_camelcase
+from mosaic import TileCache, process_tile_image
 
-CONTENT_BASE_URL = "https://ordinals.com/content/"
+CONTENT_BASE_URL = os.environ.get('CONTENT_BASE_URL', "https://ordinals.com/content/")
+DOWNLOAD_WORKERS = 16 # number of inscriptions downloaded at the same time
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_BACKOFF_SECONDS = 1 # doubled after every failed attempt
+DOWNLOAD_TIMEOUT_SECONDS = 30
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+MANIFEST_SAVE_INTERVAL = 100 # completed downloads between manifest saves
+IDS_PER_FILE = 5000
 
 # If directory images doesn't exist, then create it
 IMG_DIR = 'images'
 if not os.path.exists(IMG_DIR):
     os.mkdir(IMG_DIR)
+# downloads are written here first and then renamed into place, so a tiles folder never holds a partial file
+PARTIAL_DIR = IMG_DIR + '/.partial'
 
-def download_inscription_content(id, save_to_folder):
+def get_manifest_path(slug):
+    return IMG_DIR + '/' + slug + '-manifest.json'
+
+def load_manifest(slug):
+    # the manifest records the size of every completed download, so an interrupted run can resume where it stopped
+    manifest_path = get_manifest_path(slug)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        return json.load(f)
+
+def save_manifest(slug, manifest):
+    manifest_path = get_manifest_path(slug)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def create_session():
+    # one pooled session shared by all the download threads, so connections get reused
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=DOWNLOAD_WORKERS)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def is_download_complete(session, id, filename, manifest):
+    if not os.path.exists(filename):
+        return False
+    file_bytes = os.path.getsize(filename)
+    if id in manifest:
+        return manifest[id]['bytes'] == file_bytes
+    # downloaded before there was a manifest, so check the size against the server before trusting it
+    try:
+        res = session.head(CONTENT_BASE_URL + id, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT_SECONDS)
+        content_length = res.headers.get('Content-Length')
+        return res.status_code == 200 and (content_length is None or int(content_length) == file_bytes)
+    except requests.RequestException:
+        return False
+
+def download_inscription_content(session, id, save_to_folder):
+    # returns the number of bytes downloaded, or None if the inscription couldn't be retrieved
     filename = save_to_folder + '/' + id
-    if os.path.exists(filename):
-        print('Image already downloaded: ', filename)
-        return
+    tmp_filename = PARTIAL_DIR + '/' + os.path.basename(save_to_folder) + '-' + id
     contentUrl = CONTENT_BASE_URL + id
-    res = requests.get(contentUrl, stream=True)
-    if res.status_code == 200:
-        with open(filename,'wb') as f:
-            shutil.copyfileobj(res.raw, f)
-        print('Image sucessfully Downloaded: ',filename)
-    else:
-        print('Image Couldn\'t be retrieved')
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        if attempt:
+            time.sleep(DOWNLOAD_BACKOFF_SECONDS * 2 ** (attempt - 1))
+        try:
+            with session.get(contentUrl, stream=True, timeout=DOWNLOAD_TIMEOUT_SECONDS) as res:
+                if res.status_code != 200:
+                    if res.status_code in RETRY_STATUS_CODES:
+                        continue
+                    break
+                with open(tmp_filename, 'wb') as f:
+                    shutil.copyfileobj(res.raw, f)
+                file_bytes = os.path.getsize(tmp_filename)
+                content_length = res.headers.get('Content-Length')
+                if content_length is not None and int(content_length) != file_bytes:
+                    continue
+            os.replace(tmp_filename, filename)
+            print('Image sucessfully Downloaded: ', filename)
+            return file_bytes
+        except (requests.RequestException, urllib3.exceptions.HTTPError, OSError):
+            # reading res.raw directly can raise urllib3 and socket errors that requests doesn't wrap
+            continue
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
+    print('Image Couldn\'t be retrieved: ', contentUrl)
+    return None
+
+def get_average_color(img, id, slug):
+    average_color_floats = ImageStat.Stat(img).mean
+    average_color_ints = list(map(int, average_color_floats))
+    if len(average_color_ints) < 3:
+        print('Only got one grayscale value for image ' + id + ' in ' + slug + ', will extrapolate to RGB')
+        average_color_ints = [average_color_ints[0], average_color_ints[0], average_color_ints[0]]
+    return [average_color_ints[0], average_color_ints[1], average_color_ints[2]]
+
+def get_inscription_stats(filename, id, slug):
+    # decodes the image once and returns both its average color for colors.js and the tile mosaic.py matches with
+    with Image.open(filename) as img:
+        img.load()
+        return (get_average_color(img, id, slug), process_tile_image(img, os.path.getsize(filename)))
+
+def download_all_inscription_content(slug, ids, save_to_folder, known_colors=None):
+    # downloads every id that isn't already complete on disk and computes its average color for colors.js, along
+    # with the tile mosaic.py matches against, while the image is decoded anyway. Returns the ids that could not be
+    # retrieved or decoded. Ids in known_colors already have their color in colors.js, so aren't decoded for it
+    os.makedirs(PARTIAL_DIR, exist_ok=True)
+    manifest = load_manifest(slug)
+    manifest_lock = threading.Lock()
+    session = create_session()
+    tile_cache = TileCache(save_to_folder)
+    known_colors = known_colors or {}
+    failed_ids = []
+    num_completed = [0]
+
+    def download(id):
+        filename = save_to_folder + '/' + id
+        if is_download_complete(session, id, filename, manifest):
+            entry = dict(manifest.get(id, {'bytes': os.path.getsize(filename)}))
+        else:
+            file_bytes = download_inscription_content(session, id, save_to_folder)
+            entry = None if file_bytes is None else {'bytes': file_bytes}
+        tile = None
+        if entry is not None:
+            file_stats = os.stat(filename)
+            has_tile, _ = tile_cache.get(id, file_stats)
+            if 'color' not in entry and id in known_colors:
+                entry['color'] = known_colors[id]
+            if 'color' not in entry or not has_tile:
+                try:
+                    entry['color'], tile = get_inscription_stats(filename, id, slug)
+                except Exception:
+                    print('Image Couldn\'t be decoded: ', filename)
+                    entry = None
+        with manifest_lock:
+            if entry is None:
+                failed_ids.append(id)
+                manifest.pop(id, None)
+            else:
+                if tile is not None:
+                    tile_cache.put(id, file_stats, tile)
+                manifest[id] = entry
+                num_completed[0] += 1
+                if num_completed[0] % MANIFEST_SAVE_INTERVAL == 0:
+                    save_manifest(slug, manifest)
+
+    executor = ThreadPoolExecutor(DOWNLOAD_WORKERS)
+    try:
+        # list() so that any unexpected exception from a download gets raised here
+        list(executor.map(download, ids))
+    finally:
+        # on Ctrl-C, drop the queued downloads and only wait for the ones in flight
+        executor.shutdown(cancel_futures=True)
+        with manifest_lock:
+            save_manifest(slug, manifest)
+            tile_cache.save()
+    return failed_ids
 
 def fetch_ids_from_ow(slug):
     print("Fetching ids from ordinals wallet for " + slug)
@@ -52,7 +192,30 @@ def fetch_ids_from_deezy(slug):
         print("Error fetching ids from deezy for " + slug)
         return []
     return resp.text.split('\n')
-def download_inscriptions(slugs):
+def read_js_array(js_file):
+    # ids and colors files are a single `const name = [...]` statement
+    with open(js_file) as f:
+        return json.loads(f.read().split('=', 1)[1])
+
+def read_existing_ids(slug):
+    existing_ids = []
+    i = 1
+    while os.path.isfile(f'collections/{slug}/ids{i}.js'):
+        existing_ids += read_js_array(f'collections/{slug}/ids{i}.js')
+        i += 1
+    return existing_ids
+
+def write_if_changed(file_name, content):
+    # returns whether the file changed. Unchanged files are left alone, they don't need to be inscribed again
+    if os.path.isfile(file_name):
+        with open(file_name) as f:
+            if f.read() == content:
+                return False
+    with open(file_name, 'w') as f:
+        f.write(content)
+    return True
+
+def download_inscriptions(slugs, incremental=False):
     for slug in slugs:
         # Sometimes ordinals wallet has incomplete list, so we check from two places.
         print("Downloading inscriptions for " + slug)
@@ -69,34 +232,53 @@ def download_inscriptions(slugs):
         if not os.path.exists(img_folder):
             os.mkdir(img_folder)
         trimmed_ids = [id for id in ids if id != ""]
-        for id in trimmed_ids:
-            download_inscription_content(id, img_folder)
 
-        trimmed_ids = sorted(trimmed_ids)
+        known_colors = {}
+        if incremental:
+            # keep every id that is already in the collection at its index, so orderedIdNums in mosaics that are
+            # already inscribed stay valid, and only append the new ones
+            existing_ids = read_existing_ids(slug)
+            if existing_ids and os.path.isfile(f'collections/{slug}/colors.js'):
+                existing_colors = read_js_array(f'collections/{slug}/colors.js')
+                if len(existing_colors) == len(existing_ids):
+                    known_colors = dict(zip(existing_ids, existing_colors))
+            existing_ids_set = set(existing_ids)
+            new_ids = sorted(set(trimmed_ids) - existing_ids_set)
+            print(slug + ': ' + str(len(new_ids)) + ' new ids')
+            trimmed_ids = existing_ids + new_ids
+        else:
+            trimmed_ids = sorted(trimmed_ids)
+
+        failed_ids = download_all_inscription_content(slug, trimmed_ids, img_folder, known_colors)
+        if failed_ids:
+            print(str(len(failed_ids)) + ' inscriptions for ' + slug + ' could not be downloaded or decoded, run again to retry them')
+            continue
+        manifest = load_manifest(slug)
+
         print(slug + ' ' + str(len(trimmed_ids)))
-        id_chunks = [trimmed_ids[i:i + 5000] for i in range(0, len(trimmed_ids), 5000)]
+        id_chunks = [trimmed_ids[i:i + IDS_PER_FILE] for i in range(0, len(trimmed_ids), IDS_PER_FILE)]
         camelcase_slug = dash_to_camelcase(slug)
         if not os.path.exists(f'collections/{slug}'):
             print(f'making dir: collections/{slug}')
             os.mkdir(f'collections/{slug}')
+        changed_files = []
         for i, id_chunk in enumerate(id_chunks):
             ids_file = f'collections/{slug}/ids{i+1}.js'
-            with open(ids_file, 'w') as f:
-                f.write('const ' + camelcase_slug + f'Ids{i+1}=["' + '","'.join(id_chunk) + '"]')
-        colors_list = []
-        print("Calculating average colors for " + slug + "...")
-        for id in trimmed_ids:
-            img = Image.open('images/' + slug + '/' + id)
-            average_color_floats = ImageStat.Stat(img).mean
-            average_color_ints = list(map(int, average_color_floats))
-            if len(average_color_ints) == 1:
-                print('Only got one grayscale value for image ' + id + ' in ' + slug + ', will extrapolate to RGB')
-                average_color_ints = [average_color_ints[0], average_color_ints[0], average_color_ints[0]]
-            colors_list.append([average_color_ints[0], average_color_ints[1], average_color_ints[2]])
+            if write_if_changed(ids_file, 'const ' + camelcase_slug + f'Ids{i+1}=["' + '","'.join(id_chunk) + '"]'):
+                changed_files.append(ids_file)
+        # the average colors were computed as the images were downloaded
+        colors_list = [known_colors[id] if id in known_colors else manifest[id]['color'] for id in trimmed_ids]
         colors_file = f'collections/{slug}/colors.js'
-        with open(colors_file, 'w') as f:
-            f.write('const ' + camelcase_slug + 'Colors = ' + json.dumps(colors_list, separators=(",", ":")))
+        if write_if_changed(colors_file, 'const ' + camelcase_slug + 'Colors = ' + json.dumps(colors_list, separators=(",", ":"))):
+            changed_files.append(colors_file)
+        if changed_files:
+            print('Changed files for ' + slug + ' (inscribe these and update info.json): ' + ', '.join(changed_files))
+        else:
+            print('No changes for ' + slug)
 
 if __name__ == '__main__':
-    slugs = sys.argv[1].split(',')
-    download_inscriptions(slugs)
+    parser = argparse.ArgumentParser(description='Download the inscriptions of one or more collections and write their ids and colors files')
+    parser.add_argument('slugs', help='comma separated list of collection slugs')
+    parser.add_argument('--incremental', action='store_true', help='keep existing ids at their index and only append new ones, so unchanged ids files don\'t need to be inscribed again')
+    args = parser.parse_args()
+    download_inscriptions(args.slugs.split(','), args.incremental)
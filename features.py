@@ -0,0 +1,48 @@
+import numpy as np
+
+# Perceptual match features, see MATCH_FEATURES in mosaic.py
+
+# linear sRGB to CIE XYZ, and the D65 white point
+RGB_TO_XYZ = np.array([
+    [0.4124564, 0.3575761, 0.1804375],
+    [0.2126729, 0.7151522, 0.0721750],
+    [0.0193339, 0.1191920, 0.9503041],
+])
+WHITE_D65 = np.array([0.95047, 1.0, 1.08883])
+BLOCK_SIZE = 4096	# number of images converted at once, keeps the float64 intermediates small
+
+def srgb_to_lab(pixels):
+    # (..., 3) sRGB values from 0 to 255 to CIELAB
+    rgb = np.asarray(pixels, dtype=np.float64) / 255
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, ((rgb + 0.055) / 1.055) ** 2.4)
+    xyz = (linear @ RGB_TO_XYZ.T) / WHITE_D65
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    return np.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis=-1)
+
+def get_dct_matrix(n):
+    # orthonormal DCT-II, so squared distances between full coefficient sets equal those between the pixels
+    k, i = np.meshgrid(np.arange(n), np.arange(n), indexing='ij')
+    matrix = np.sqrt(2 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+def get_lab_dct_features(images, coefficients):
+    # the coefficients x coefficients lowest frequency DCT coefficients of every CIELAB channel of (N x px x px x 3)
+    # images, as an (N x coefficients^2 * 3) array, the channels being the last axis. The first three values are the
+    # DC coefficients, the average CIELAB colour times px, which TileFitter shortlists candidates on
+    px = images.shape[1]
+    coefficients = min(coefficients, px)
+    dct = get_dct_matrix(px)[:coefficients]
+    features = np.zeros((len(images), coefficients * coefficients * 3))
+    for start in range(0, len(images), BLOCK_SIZE):
+        lab = srgb_to_lab(images[start:start + BLOCK_SIZE])
+        block = np.einsum('ki,nijc,lj->nklc', dct, lab, dct, optimize=True)
+        features[start:start + BLOCK_SIZE] = block.reshape(len(block), -1)
+    return features
+
+def get_mean_delta_e(images, other_images):
+    # mean CIE76 colour difference between the pixels of two sets of images
+    total = 0.0
+    for start in range(0, len(images), BLOCK_SIZE):
+        total += np.linalg.norm(srgb_to_lab(images[start:start + BLOCK_SIZE]) - srgb_to_lab(other_images[start:start + BLOCK_SIZE]), axis=-1).sum()
+    return total / max(images[..., 0].size, 1)
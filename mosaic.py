@@ -1,60 +1,361 @@
-import sys
 import os, os.path
-import random
-import math
+import time
 import json
+import re
+import base64
+import hashlib
+import argparse
+import tempfile
+import numpy as np
 from PIL import Image, ImageOps, ImageStat
-from multiprocessing import Process, Queue, cpu_count
+from multiprocessing import Array, Pool, Process, Queue, cpu_count, shared_memory
 from util import dash_to_camelcase
+from profiling import StageProfiler, QueueDepthSampler, start_cprofile, dump_cprofile, write_report
+from assignment import TileAuction, get_candidate_edges, get_assignment_errors
+from features import get_lab_dct_features
 
 # Change these config parameters to suit your needs...
 NUM_TILES_PER_ROW = 100
+KEEP_ASPECT_RATIO = False	# if True the mosaic has as many rows as keep the target's aspect ratio, otherwise it is square
 RANDOM_RANGE = 0
+SEED = None	# if set, every random choice derives from it and the matching runs in order in the main process, so the same inputs give the same mosaic with any WORKER_COUNT
 REPEAT = 'ALL_INCLUDED' # 'STRICT_NO', 'MINIMIZED', 'ALL_INCLUDED', 'OK',
+REPEAT_MODES = ('STRICT_NO', 'MINIMIZED', 'ALL_INCLUDED', 'OK')
 TILE_SIZE      = 50		# height/width of mosaic tiles in pixels
 TILE_MATCH_RES = 10		# tile matching resolution (higher values give better fit but require more processing)
-TILE_BLOCK_SIZE = TILE_SIZE / max(min(TILE_MATCH_RES, TILE_SIZE), 1)
+TILE_MATCH_RES_PX = max(min(TILE_MATCH_RES, TILE_SIZE), 1)	# height/width of the small tiles used for matching
+TILE_BLOCK_SIZE = TILE_SIZE / TILE_MATCH_RES_PX
+MATCH_FEATURES = 'rgb'	# 'rgb' compares the raw pixels, 'lab-dct' the low frequency DCT coefficients of the CIELAB image (fewer values, closer to how we see colour)
+MATCH_FEATURES_MODES = ('rgb', 'lab-dct')
+DCT_COEFFICIENTS = 4	# with 'lab-dct', the DCT_COEFFICIENTS x DCT_COEFFICIENTS lowest frequencies of every channel get compared
 DIFF_RANDOM_VAR = 0
+MATCH_BLOCK_SIZE = 64	# number of cells scored against the tiles in one batched operation
+CANDIDATE_COUNT = 0		# if > 0, only this many tiles closest in average colour get the full comparison (faster, may fit worse)
+CANDIDATE_AUDIT_RATE = 0.02	# fraction of cells also searched exhaustively, to report how often the shortlist changes the pick
 MAX_OCCURRENCES_PER_TILE = 10
-if REPEAT in ('STRICT_NO', 'ALL_INCLUDED'):
-	WORKER_COUNT = 1 # max(cpu_count() - 1, 1)
-else:
-	WORKER_COUNT =  max(cpu_count() - 1, 1)
+PLACEMENT = 'greedy'	# 'greedy' fits the cells one at a time in random order, 'assignment' places them all at once for the lowest total error under the REPEAT rules
+PLACEMENTS = ('greedy', 'assignment')
+ASSIGNMENT_CANDIDATES = 32	# number of closest tiles per cell the assignment chooses from
+ASSIGNMENT_REPEAT_PENALTY = 0	# with REPEAT = 'OK', extra error the assignment charges for every repeat of a tile, higher values give more unique tiles
+ASSIGNMENT_MAX_ROUNDS = 200000	# the assignment keeps the greedy placement if the bidding takes more rounds than this
+# tile usage is shared between the workers, so every REPEAT setting can use all the cores
+WORKER_COUNT = max(cpu_count() - 1, 1)
+
+PREVIEW = False	# first write a quick mosaic matched on the average colour of the tiles only, then refine it in place at TILE_MATCH_RES
+PREVIEW_REFRESH_SECONDS = 5	# with PREVIEW, how often the partly refined mosaic gets saved to OUT_FILE
+
+PROFILE = False	# write a report with the time spent in every stage, per worker throughput and queue depths to PROFILE_REPORT_FILE
+PROFILE_REPORT_FILE = 'mosaic-profile.json'
+PROFILE_CPROFILE = False	# with PROFILE, also dump a cProfile .prof file for every process
+
+TARGET_REDUCING_GAP = 3.0	# the target is shrunk by whole factors first down to this many times the matching size, then resampled
+CANVAS_MEMORY_MB = 1024	# larger mosaics are assembled in a file on disk and saved as several jpegs of this size at most
+
+# the config parameters configure() and the command line can change
+SETTINGS = ('NUM_TILES_PER_ROW', 'KEEP_ASPECT_RATIO', 'RANDOM_RANGE', 'SEED', 'REPEAT', 'TILE_SIZE', 'TILE_MATCH_RES', 'MATCH_FEATURES', 'DCT_COEFFICIENTS', 'DIFF_RANDOM_VAR',
+	'CANDIDATE_COUNT', 'MAX_OCCURRENCES_PER_TILE', 'PLACEMENT', 'ASSIGNMENT_CANDIDATES', 'ASSIGNMENT_REPEAT_PENALTY', 'ASSIGNMENT_MAX_ROUNDS', 'WORKER_COUNT', 'PREVIEW',
+	'CANVAS_MEMORY_MB', 'ID_NUMS_ENCODING', 'HTML_TEMPLATE', 'PROFILE', 'PROFILE_REPORT_FILE', 'PROFILE_CPROFILE')
 
 OUT_FILE = 'mosaic.jpeg'
 HTML_OUT_FILE = 'mosaic.html'
+PREVIEW_HTML_OUT_FILE = 'preview-do-not-inscribe.html'
+ID_NUMS_ENCODING = 'json'	# how orderedIdNums is written into the html: 'json', 'base64', 'base64-delta' or 'auto' (smallest)
+ID_NUMS_ENCODINGS = ('json', 'base64', 'base64-delta')
+HTML_TEMPLATE = 'dom'	# 'dom' adds an img for every cell, 'canvas' draws the tiles on one canvas, fetching each inscription once and the rows in view first
+HTML_TEMPLATES = ('dom', 'canvas')
+CANVAS_MAX_REQUESTS = 12	# with the canvas template, how many inscriptions are loaded at once (the maxRequests url parameter overrides it)
+USE_TILE_CACHE = True	# keep processed tiles in CACHE_DIR so repeat runs only decode new or changed files
+USE_RESULT_CACHE = True	# with SEED set, keep the placement of every render in CACHE_DIR so a re-run with the same inputs (or only a new title) skips the matching
+RESULT_CACHE_VERSION = 2	# bump when a change to the matching makes the cached placements stale
+# settings that only change how the placement is drawn, not the placement itself
+RESULT_INDEPENDENT_SETTINGS = ('TILE_SIZE', 'WORKER_COUNT', 'PREVIEW', 'CANVAS_MEMORY_MB', 'ID_NUMS_ENCODING', 'HTML_TEMPLATE', 'PROFILE',
+	'PROFILE_REPORT_FILE', 'PROFILE_CPROFILE')
+CACHE_DIR = 'cache'
+INGEST_BATCH_SIZE = 256	# number of tiles decoded per batch when reading a tiles directory
 EOQ_VALUE = None
-used_tile_data_index_counts = {}
-all_have_been_included = False
+MAIN_STATS_VALUE = 'main'	# marks the message with the main process' stage timings on the result queue
+
+def configure(**settings):
+	# changes the config parameters above, e.g. configure(NUM_TILES_PER_ROW=200, REPEAT='OK')
+	global TILE_MATCH_RES_PX, TILE_BLOCK_SIZE
+	for name, value in settings.items():
+		if name not in SETTINGS:
+			raise ValueError("Unknown setting '{}'".format(name))
+		globals()[name] = value
+	if REPEAT not in REPEAT_MODES:
+		raise ValueError("REPEAT must be one of {}".format(', '.join(REPEAT_MODES)))
+	if MATCH_FEATURES not in MATCH_FEATURES_MODES:
+		raise ValueError("MATCH_FEATURES must be one of {}".format(', '.join(MATCH_FEATURES_MODES)))
+	if SEED is not None and (not isinstance(SEED, int) or SEED < 0):
+		raise ValueError("SEED must be a non-negative integer")
+	if PLACEMENT not in PLACEMENTS:
+		raise ValueError("PLACEMENT must be one of {}".format(', '.join(PLACEMENTS)))
+	if ID_NUMS_ENCODING not in ID_NUMS_ENCODINGS + ('auto',):
+		raise ValueError("ID_NUMS_ENCODING must be one of {}".format(', '.join(ID_NUMS_ENCODINGS + ('auto',))))
+	if HTML_TEMPLATE not in HTML_TEMPLATES:
+		raise ValueError("HTML_TEMPLATE must be one of {}".format(', '.join(HTML_TEMPLATES)))
+	TILE_MATCH_RES_PX = max(min(TILE_MATCH_RES, TILE_SIZE), 1)
+	TILE_BLOCK_SIZE = TILE_SIZE / TILE_MATCH_RES_PX
+
+def configure_process(settings):
+	# Pool initializer, processes started with spawn don't inherit the settings configure() changed
+	configure(**settings)
+
+def get_rng(*keys):
+	# the random number generator for one kind of random choice, keys tell the kinds apart. Seeded from SEED and the
+	# keys when SEED is set, so the choices only depend on the inputs
+	if SEED is None:
+		return np.random.default_rng()
+	return np.random.default_rng((SEED,) + keys)
+
+def get_settings():
+	# the worker processes get these and configure() themselves, they don't inherit the changes with every start method
+	return {name: globals()[name] for name in SETTINGS}
+
+def open_square_tile(tile_path):
+	return crop_square_tile(Image.open(tile_path))
+
+def crop_square_tile(img):
+	img = ImageOps.exif_transpose(img)
+	# tiles must be square, so get the largest square that fits inside the image
+	w = img.size[0]
+	h = img.size[1]
+	min_dimension = min(w, h)
+	w_crop = (w - min_dimension) / 2
+	h_crop = (h - min_dimension) / 2
+	return img.crop((w_crop, h_crop, w - w_crop, h - h_crop))
+
+def process_tile(tile_path):
+	# this gets run by the ingestion pool, so it returns plain arrays rather than PIL images
+	try:
+		return process_tile_image(Image.open(tile_path), os.stat(tile_path).st_size)
+	except:
+		return None
+
+def process_tile_image(img, file_bytes):
+	# takes an already opened image, so that download-inscriptions.py can reuse the image it decoded for colors.js
+	img = crop_square_tile(img)
+	small_tile_img = img.resize((TILE_MATCH_RES_PX, TILE_MATCH_RES_PX))
+	average_color_floats = ImageStat.Stat(img.convert('RGB')).mean
+	average_color = list(map(int, average_color_floats))
+	return (np.asarray(small_tile_img.convert('RGB')), file_bytes, average_color)
+
+def get_match_features(images):
+	# what TileFitter compares for (N x TILE_MATCH_RES_PX x TILE_MATCH_RES_PX x 3) images, one row per image. The raw
+	# pixels keep their dtype
+	if MATCH_FEATURES == 'lab-dct':
+		return get_lab_dct_features(images.reshape(len(images), TILE_MATCH_RES_PX, TILE_MATCH_RES_PX, 3), DCT_COEFFICIENTS)
+	return images.reshape(len(images), -1)
+
+def get_match_colors(average_colors):
+	# the average colours only go with the raw pixels, for lab-dct TileFitter shortlists on the DC coefficients
+	return average_colors if MATCH_FEATURES == 'rgb' else None
+
+def load_large_tile(tile_path):
+	# large tiles are only needed for the tiles that end up in the mosaic, so they get decoded when they are placed.
+	# Returns a (TILE_SIZE x TILE_SIZE x 3) uint8 array, ready to be copied into the mosaic
+	return np.asarray(open_square_tile(tile_path).resize((TILE_SIZE, TILE_SIZE)).convert('RGB'))
+
+def save_npz(path, **arrays):
+	# writes to a temporary file of its own first, so an interrupted run never leaves a truncated file behind and
+	# processes saving the same file at once don't trip over each other's temporary file
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npz')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			np.savez(f, **arrays)
+		os.replace(tmp_path, path)
+	except:
+		os.remove(tmp_path)
+		raise
+
+class TileCache:
+	# keeps the processed tiles of one tiles directory on disk, keyed by file name (the inscription id) and the
+	# tile size settings, so that only new or changed files have to be decoded again on the next run
+	def __init__(self, tiles_directory):
+		cache_dir = os.path.join(CACHE_DIR, os.path.basename(os.path.normpath(tiles_directory)))
+		self.path = os.path.join(cache_dir, 'tiles-{}-{}.npz'.format(TILE_SIZE, TILE_MATCH_RES))
+		self.entries = {}
+		self.changed = False
+		if os.path.isfile(self.path):
+			try:
+				self.__load()
+			except Exception as e:
+				print('Ignoring unreadable tile cache {}: {}'.format(self.path, e))
+				self.entries = {}
+
+	def __load(self):
+		with np.load(self.path) as data:
+			data = {key: data[key] for key in ('names', 'file_sizes', 'mtimes', 'valid', 'small_tiles', 'average_colors')}
+		for i, name in enumerate(data['names'].tolist()):
+			file_size = int(data['file_sizes'][i])
+			tile = None
+			if data['valid'][i]:
+				tile = (data['small_tiles'][i], file_size, data['average_colors'][i].tolist())
+			self.entries[name] = ((file_size, int(data['mtimes'][i])), tile)
+
+	def get(self, tile_name, file_stats):
+		# returns (hit, tile), tile being None for files that could not be read as an image
+		entry = self.entries.get(tile_name)
+		if entry is None or entry[0] != (file_stats.st_size, file_stats.st_mtime_ns):
+			return (False, None)
+		return (True, entry[1])
+
+	def put(self, tile_name, file_stats, tile):
+		self.entries[tile_name] = ((file_stats.st_size, file_stats.st_mtime_ns), tile)
+		self.changed = True
+
+	def prune(self, tile_names):
+		# forget files that are no longer in the tiles directory
+		for tile_name in set(self.entries) - set(tile_names):
+			del self.entries[tile_name]
+			self.changed = True
+
+	def save(self):
+		if not self.changed:
+			return
+		names = sorted(self.entries)
+		small_tiles = np.zeros((len(names), TILE_MATCH_RES_PX, TILE_MATCH_RES_PX, 3), dtype=np.uint8)
+		average_colors = np.zeros((len(names), 3), dtype=np.int64)
+		file_sizes = np.zeros(len(names), dtype=np.int64)
+		mtimes = np.zeros(len(names), dtype=np.int64)
+		valid = np.zeros(len(names), dtype=bool)
+		for i, name in enumerate(names):
+			(file_sizes[i], mtimes[i]), tile = self.entries[name]
+			if tile is not None:
+				small_tiles[i], _, average_colors[i] = tile
+				valid[i] = True
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+		save_npz(self.path, names=np.array(names, dtype=str), file_sizes=file_sizes, mtimes=mtimes, valid=valid,
+			small_tiles=small_tiles, average_colors=average_colors)
+		self.changed = False
+
+class ResultCache:
+	# keeps the placement of one render, keyed by a hash of everything the placement depends on: the target image,
+	# the tiles and ids and colors of the collections, and the settings. The title, the content base url and the
+	# TILE_SIZE aren't part of it, so a render that only changes those reuses the placement
+	def __init__(self, image_bytes, slug_names):
+		key = hashlib.sha256()
+		key.update(image_bytes)
+		for slug in slug_names:
+			key.update(json.dumps(slug).encode())
+			collection_dir = os.path.join('collections', slug)
+			for file_name in sorted(os.listdir(collection_dir)) if os.path.isdir(collection_dir) else []:
+				with open(os.path.join(collection_dir, file_name), 'rb') as f:
+					key.update(json.dumps(file_name).encode() + f.read())
+			tiles_dir = os.path.join('images', slug)
+			key.update(json.dumps([(tile_name, os.stat(os.path.join(tiles_dir, tile_name)).st_size) for tile_name in sorted(os.listdir(tiles_dir))]).encode())
+		settings = {name: value for name, value in get_settings().items() if name not in RESULT_INDEPENDENT_SETTINGS}
+		settings.update(TILE_MATCH_RES_PX=TILE_MATCH_RES_PX, MATCH_BLOCK_SIZE=MATCH_BLOCK_SIZE, CANDIDATE_AUDIT_RATE=CANDIDATE_AUDIT_RATE, version=RESULT_CACHE_VERSION)
+		key.update(json.dumps(settings, sort_keys=True).encode())
+		self.path = os.path.join(CACHE_DIR, 'results', key.hexdigest() + '.npz')
+
+	def get(self, cell_boxes):
+		# the tile index of every cell in cell_boxes, -1 for the empty ones, or None if there is no placement yet
+		if not os.path.isfile(self.path):
+			return None
+		try:
+			with np.load(self.path) as data:
+				grid = data['tile_indexes']
+		except Exception as e:
+			print('Ignoring unreadable result cache {}: {}'.format(self.path, e))
+			return None
+		return grid[cell_boxes[:, 1] // TILE_SIZE, cell_boxes[:, 0] // TILE_SIZE]
+
+	def put(self, cell_boxes, tile_indexes):
+		# stored as a grid of rows, so it doesn't depend on the order the cells were matched in or on TILE_SIZE
+		grid = np.full((cell_boxes[:, 3].max() // TILE_SIZE, cell_boxes[:, 2].max() // TILE_SIZE), -1)
+		grid[cell_boxes[:, 1] // TILE_SIZE, cell_boxes[:, 0] // TILE_SIZE] = tile_indexes
+		os.makedirs(os.path.dirname(self.path), exist_ok=True)
+		save_npz(self.path, tile_indexes=grid)
+
+def get_result_cache(image_bytes, slug_names):
+	# results are only worth keeping when they can be reproduced
+	if not USE_RESULT_CACHE or SEED is None:
+		return None
+	return ResultCache(image_bytes, slug_names)
+
+def read_collection_ids(slug):
+	# the inscription ids of a collection in the order of its ids files, which is how the html numbers them
+	ids = []
+	i = 1
+	while os.path.isfile('./collections/{}/ids{}.js'.format(slug, i)):
+		with open('./collections/{}/ids{}.js'.format(slug, i)) as f:
+			ids += json.loads(f.read().split('=', 1)[1])
+		i += 1
+	return ids
+
+def get_tile_id_nums(tile_paths, slug_names):
+	# the index of every tile in the inscriptionIds of the html, -1 for tiles that aren't in it. The tiles are read in
+	# file name order, but collections updated with --incremental list their new ids after the existing ones
+	id_nums = {}
+	offset = 0
+	for slug in slug_names:
+		ids = read_collection_ids(slug)
+		for i, inscription_id in enumerate(ids):
+			id_nums.setdefault(inscription_id, offset + i)
+		offset += len(ids)
+	return np.array([id_nums.get(os.path.basename(tile_path), -1) for tile_path in tile_paths], dtype=np.int64)
 
 class TileProcessor:
 	def __init__(self, tiles_directory):
 		self.tiles_directory = tiles_directory
 
-	def __process_tile(self, tile_path):
-		try:
-			img = Image.open(tile_path)
-			img = ImageOps.exif_transpose(img)
-			file_stats = os.stat(tile_path)
-			file_bytes = file_stats.st_size
-			# tiles must be square, so get the largest square that fits inside the image
-			w = img.size[0]
-			h = img.size[1]
-			min_dimension = min(w, h)
-			w_crop = (w - min_dimension) / 2
-			h_crop = (h - min_dimension) / 2
-			img = img.crop((w_crop, h_crop, w - w_crop, h - h_crop))
-
-			large_tile_img = img.resize((TILE_SIZE, TILE_SIZE))
-			small_tile_img = img.resize((int(TILE_SIZE/TILE_BLOCK_SIZE), int(TILE_SIZE/TILE_BLOCK_SIZE)))
-			average_color_floats = ImageStat.Stat(img).mean
-			average_color = list(map(int, average_color_floats))
-			return (large_tile_img.convert('RGB'), small_tile_img.convert('RGB'), file_bytes, average_color)
-		except:
-			return (None, None)
+	def __process_tiles(self, tile_paths, pool):
+		# decode in bounded batches so only INGEST_BATCH_SIZE decoded tiles are ever in flight
+		for i in range(0, len(tile_paths), INGEST_BATCH_SIZE):
+			batch = tile_paths[i:i + INGEST_BATCH_SIZE]
+			print('Reading {:40.40}'.format(os.path.basename(batch[0])), flush=True, end='\r')
+			if pool:
+				yield from pool.map(process_tile, batch, chunksize=max(len(batch) // (4 * WORKER_COUNT), 1))
+			else:
+				yield from map(process_tile, batch)
+
+	def iter_tile_batches(self):
+		# yields (file_names, small_tiles, file_sizes, average_colors) batches in file name order, with the small tiles
+		# packed into one uint8 array per batch
+		files = sorted(os.listdir(self.tiles_directory))
+		# files that aren't in the ids of the collection can't be referenced by the html
+		collection_ids = set(read_collection_ids(os.path.basename(os.path.normpath(self.tiles_directory))))
+		if collection_ids:
+			files = [tile_name for tile_name in files if tile_name in collection_ids]
+		cache = TileCache(self.tiles_directory) if USE_TILE_CACHE else None
+		tiles = {}
+		missing = []
+		for tile_name in files:
+			file_stats = os.stat(os.path.join(self.tiles_directory, tile_name))
+			hit, tile = cache.get(tile_name, file_stats) if cache else (False, None)
+			if hit:
+				tiles[tile_name] = tile
+			else:
+				missing.append((tile_name, file_stats))
+		if missing:
+			print('Decoding {} tiles ({} from cache)...'.format(len(missing), len(tiles)))
+			tile_paths = [os.path.join(self.tiles_directory, tile_name) for tile_name, _ in missing]
+			pool = Pool(WORKER_COUNT, initializer=configure_process, initargs=(get_settings(),)) if WORKER_COUNT > 1 and len(missing) > INGEST_BATCH_SIZE else None
+			try:
+				for (tile_name, file_stats), tile in zip(missing, self.__process_tiles(tile_paths, pool)):
+					tiles[tile_name] = tile
+					if cache:
+						cache.put(tile_name, file_stats, tile)
+			finally:
+				if pool:
+					pool.close()
+		if cache:
+			cache.prune(files)
+			cache.save()
+
+		for i in range(0, len(files), INGEST_BATCH_SIZE):
+			batch = [(tile_name, tiles[tile_name]) for tile_name in files[i:i + INGEST_BATCH_SIZE] if tiles[tile_name] is not None]
+			if batch:
+				yield (
+					[tile_name for tile_name, _ in batch],
+					np.stack([tile[0] for _, tile in batch]),
+					[tile[1] for _, tile in batch],
+					np.array([tile[2] for _, tile in batch], dtype=np.int64),
+				)
 
 	def get_tiles(self):
-		large_tiles = []
+		tile_paths = []
 		small_tiles = []
 		file_names = []
 		file_sizes = []
@@ -62,146 +363,263 @@ class TileProcessor:
 
 		print('Reading tiles from {}...'.format(self.tiles_directory))
 
-		files = os.listdir(self.tiles_directory)
-		for tile_name in sorted(files):
-			print('Reading {:40.40}'.format(tile_name), flush=True, end='\r')
-			tile_path = os.path.join(self.tiles_directory, tile_name)
-			large_tile, small_tile, size_bytes, average_color = self.__process_tile(tile_path)
-			if large_tile:
-				large_tiles.append(large_tile)
-				small_tiles.append(small_tile)
-				file_names.append(tile_name)
-				file_sizes.append(size_bytes)
-				average_colors.append(average_color)
+		for batch_names, batch_small_tiles, batch_sizes, batch_colors in self.iter_tile_batches():
+			tile_paths.extend(os.path.join(self.tiles_directory, tile_name) for tile_name in batch_names)
+			file_names.extend(batch_names)
+			small_tiles.append(batch_small_tiles)
+			file_sizes.extend(batch_sizes)
+			average_colors.append(batch_colors)
+
+		print('Processed {} tiles.'.format(len(file_names)))
 
-		print('Processed {} tiles.'.format(len(large_tiles)))
+		if not file_names:
+			return ([], np.zeros((0, TILE_MATCH_RES_PX, TILE_MATCH_RES_PX, 3), dtype=np.uint8), [], [], np.zeros((0, 3), dtype=np.int64))
+		return (tile_paths, np.concatenate(small_tiles), file_names, file_sizes, np.concatenate(average_colors))
 
-		return (large_tiles, small_tiles, file_names, file_sizes, average_colors)
+def open_large_image(path):
+	# for files we chose, like the target from the command line and the saved mosaic bands, Pillow's decompression
+	# bomb check, which warns past 89 MP and refuses past 178 MP, is lifted. It still applies to everything else
+	max_image_pixels = Image.MAX_IMAGE_PIXELS
+	Image.MAX_IMAGE_PIXELS = None
+	try:
+		return Image.open(path)
+	finally:
+		Image.MAX_IMAGE_PIXELS = max_image_pixels
 
 class TargetImage:
-	def __init__(self, image_path):
+	def __init__(self, image_path, trusted=False):
+		# only a trusted target can be larger than Pillow's decompression bomb limit, serve.py's uploads aren't
 		self.image_path = image_path
+		self.trusted = trusted
 
 	def get_data(self):
+		# returns the (width, height) of the mosaic and the target image at the matching resolution. The target is
+		# never resized to the full mosaic size, that would take gigabytes for the larger grids
 		print('Processing main image...')
-		img = Image.open(self.image_path)
-		# w = img.size[0] * ENLARGEMENT
-		# h = img.size[1]	* ENLARGEMENT
-		w = NUM_TILES_PER_ROW * TILE_SIZE
-		h = w
-		large_img = img.resize((w, h))
-		w_diff = (w % TILE_SIZE)/2
-		h_diff = (h % TILE_SIZE)/2
-		
-		# if necessary, crop the image slightly so we use a whole number of tiles horizontally and vertically
-		if w_diff or h_diff:
-			large_img = large_img.crop((w_diff, h_diff, w - w_diff, h - h_diff))
-
-		small_img = large_img.resize((int(w/TILE_BLOCK_SIZE), int(h/TILE_BLOCK_SIZE)))
-
-		image_data = (large_img.convert('RGB'), small_img.convert('RGB'))
+		img = open_large_image(self.image_path) if self.trusted else Image.open(self.image_path)
+		x_tile_count = NUM_TILES_PER_ROW
+		y_tile_count = max(round(NUM_TILES_PER_ROW * img.size[1] / img.size[0]), 1) if KEEP_ASPECT_RATIO else x_tile_count
+
+		small_size = (x_tile_count * TILE_MATCH_RES_PX, y_tile_count * TILE_MATCH_RES_PX)
+		# only the small image is needed, so jpegs get decoded at 1/2, 1/4 or 1/8 of their size where that is still
+		# larger than it, and other images are shrunk by whole factors first. Much faster and lighter for high
+		# resolution sources
+		img.draft('RGB', small_size)
+		if img.mode != 'RGB':
+			img = img.convert('RGB')
+		small_img = img.resize(small_size, reducing_gap=TARGET_REDUCING_GAP)
+
+		image_data = ((x_tile_count * TILE_SIZE, y_tile_count * TILE_SIZE), small_img)
 
 		print('Main image processed.')
 
 		return image_data
 
 class TileFitter:
-	def __init__(self, tiles_data, file_sizes):
+	def __init__(self, tiles_data, file_sizes, used_tile_counts=None, average_colors=None):
 		self.tiles_data = tiles_data
 		self.file_sizes = file_sizes
+		# pack every small tile into one contiguous (N_tiles x TILE_MATCH_RES^2 * 3) array so a cell can be scored
+		# against all tiles in one operation. float64 keeps the SSD exact, the sums never get near 2^53
+		self.tiles_array = np.asarray(tiles_data, dtype=np.float64).reshape(len(tiles_data), -1)
+		self.tiles_sq_norms = np.einsum('ij,ij->i', self.tiles_array, self.tiles_array)
+		# the average colours are the coarse signature used to shortlist candidates when CANDIDATE_COUNT is set
+		if average_colors is None:
+			average_colors = self.get_colors(self.tiles_array)
+		self.tile_colors = np.asarray(average_colors, dtype=np.float64)
+		self.tile_colors_sq_norms = np.einsum('ij,ij->i', self.tile_colors, self.tile_colors)
+		# usage counts live in shared memory so that every worker sees the tiles the others have already placed
+		if used_tile_counts is None:
+			used_tile_counts = Array('q', len(tiles_data))
+		self.usage_lock = used_tile_counts.get_lock()
+		self.used_tile_counts = np.frombuffer(used_tile_counts.get_obj(), dtype=np.int64)
+		self.stats = {'audited_cells': 0, 'audit_mismatches': 0, 'candidate_fallbacks': 0, 'picks': 0, 'skipped_tiles': 0, 'full_comparisons': 0, 'possible_comparisons': 0}
+		self.seed(0)
+
+	def seed(self, start):
+		# the random choices for the block of cells from index start on, so they don't depend on who matches which block
+		self.rng = get_rng(1, start)
+
+	def __jitter(self, diffs):
+		if DIFF_RANDOM_VAR:
+			# introduce an optional slight random variation that helps prevent repeat image showing up next to each other
+			diffs *= 1 + ((self.rng.random(diffs.shape) * DIFF_RANDOM_VAR) - DIFF_RANDOM_VAR / 2)
+		return diffs
+
+	def get_tile_diffs(self, cells_data):
+		# sum of squared differences between every cell in the block and every tile, as a (N_cells x N_tiles) array
+		cells = np.asarray(cells_data, dtype=np.float64).reshape(len(cells_data), -1)
+		cells_sq_norms = np.einsum('ij,ij->i', cells, cells)
+		diffs = cells_sq_norms[:, None] - 2 * (cells @ self.tiles_array.T) + self.tiles_sq_norms[None, :]
+		return self.__jitter(diffs)
+
+	def get_colors(self, features):
+		# the average colour of the raw pixels, or for lab-dct the DC coefficients, which are the average CIELAB
+		# colour times the block size
+		if MATCH_FEATURES == 'lab-dct':
+			return features[:, :3]
+		return features.reshape(len(features), -1, 3).mean(axis=1)
 
-	def __get_tile_diff(self, t1, t2, bail_out_value):
-		diff = 0
-		# introduce an optional slight random variation that helps prevent repeat image showing up next to each other
-		rand_scale = 1 + ((random.random() * DIFF_RANDOM_VAR) - DIFF_RANDOM_VAR / 2)
-		for i in range(len(t1)):
-			#diff += (abs(t1[i][0] - t2[i][0]) + abs(t1[i][1] - t2[i][1]) + abs(t1[i][2] - t2[i][2]))
-			diff += rand_scale * ((t1[i][0] - t2[i][0])**2 + (t1[i][1] - t2[i][1])**2 + (t1[i][2] - t2[i][2])**2)
-			if diff > bail_out_value:
-				# we know already that this isn't going to be the best fit, so no point continuing with this tile
-				return diff
-		return diff
-
-	def should_skip(self, tile_index):
-		global all_have_been_included
-		# If it hasn't been used yet, then we should not skip it
-		if tile_index not in used_tile_data_index_counts:
-			# print('Tile {} has not been used yet, will not skip'.format(tile_index))
-			return False
-		# If it has been used, then we might skip it depending on the REPEAT setting. ALL_INCLUDED setting ensures that
+	def get_candidate_diffs(self, cells_data):
+		# shortlist the CANDIDATE_COUNT tiles closest to each cell in average colour, then score only those at full
+		# resolution. Returns (N_cells x CANDIDATE_COUNT) arrays of tile indexes and their diffs
+		cells = np.asarray(cells_data, dtype=np.float64).reshape(len(cells_data), -1)
+		cell_colors = self.get_colors(cells)
+		color_diffs = self.tile_colors_sq_norms[None, :] - 2 * (cell_colors @ self.tile_colors.T)
+		# tiles that are already used up can't be picked, so don't waste candidate slots on them. The counts may
+		# change before the pick, choose_tile checks them again under the lock
+		color_diffs[:, self.get_skip_mask()] = np.inf
+		candidates = np.argpartition(color_diffs, CANDIDATE_COUNT - 1, axis=1)[:, :CANDIDATE_COUNT]
+		# keep candidates in tile order so that equal diffs resolve to the same tile as the exhaustive search
+		candidates.sort(axis=1)
+		candidate_tiles = self.tiles_array[candidates]
+		diffs = np.einsum('ij,ij->i', cells, cells)[:, None] - 2 * np.einsum('ij,ikj->ik', cells, candidate_tiles) + self.tiles_sq_norms[candidates]
+		return (candidates, self.__jitter(diffs))
+
+	def get_skip_mask(self):
+		used = self.used_tile_counts > 0
+		all_have_been_included = bool(used.all())
+		# Used tiles might be skipped depending on the REPEAT setting. ALL_INCLUDED setting ensures that
 		# all tiles have been used before allowing any duplicates...
 		if REPEAT in ['STRICT_NO', 'MINIMIZED'] or (REPEAT == 'ALL_INCLUDED' and not all_have_been_included):
-			# print('Tile {} has been used before, and not all have been included'.format(tile_index))
-			return True
-		# If we've exceeded the max occurrences for this tile, then skip it
-		if used_tile_data_index_counts[tile_index] >= MAX_OCCURRENCES_PER_TILE:
-			# print('Tile {} has been used {} times, which is more than the max allowed'.format(tile_index, used_tile_data_index_counts[tile_index]))
-			return True
-		return False
-	def get_best_fit_tile(self, img_data):
-		global all_have_been_included
-		best_fit_tile_index = None
-		min_diff = sys.maxsize
-		tile_index = 0
-		if len(used_tile_data_index_counts) == len(self.tiles_data):
-			all_have_been_included = True
-		# go through each tile in turn looking for the best match for the part of the image represented by 'img_data'
-		for i in range(len(self.tiles_data)):
-			tile_data = self.tiles_data[i]
-			if self.should_skip(tile_index):
-				tile_index += 1
-				continue
-			diff = self.__get_tile_diff(img_data, tile_data, min_diff)
-			if diff < min_diff:
-				min_diff = diff
-				best_fit_tile_index = tile_index
-			tile_index += 1
-
-		if best_fit_tile_index not in used_tile_data_index_counts:
-			used_tile_data_index_counts[best_fit_tile_index] = 0
-		used_tile_data_index_counts[best_fit_tile_index] += 1
+			return used
+		# If we've exceeded the max occurrences for a tile, then skip it
+		return self.used_tile_counts >= MAX_OCCURRENCES_PER_TILE
+
+	def choose_tile(self, diffs, candidates=None, audit_diffs=None):
+		# the expensive scoring happens outside the lock, only the pick and the count update are serialized
+		with self.usage_lock:
+			skip_mask = self.get_skip_mask()
+			self.stats['picks'] += 1
+			self.stats['skipped_tiles'] += int(np.count_nonzero(skip_mask))
+			masked_diffs = np.where(skip_mask if candidates is None else skip_mask[candidates], np.inf, diffs)
+			# argmin returns the first of equal diffs, which is the same tile the old sequential scan settled on
+			best_fit_index = int(np.argmin(masked_diffs))
+			if masked_diffs[best_fit_index] == np.inf:
+				return None
+			best_fit_tile_index = best_fit_index if candidates is None else int(candidates[best_fit_index])
+			if audit_diffs is not None:
+				# compare against what the exhaustive search would have picked with the same usage counts
+				self.stats['audited_cells'] += 1
+				if int(np.argmin(np.where(skip_mask, np.inf, audit_diffs))) != best_fit_tile_index:
+					self.stats['audit_mismatches'] += 1
+			self.used_tile_counts[best_fit_tile_index] += 1
 		return best_fit_tile_index
 
-def fit_tiles(work_queue, result_queue, tiles_data, file_sizes):
-	# this function gets run by the worker processes, one on each CPU core
-	tile_fitter = TileFitter(tiles_data, file_sizes)
+	def get_best_fit_tiles(self, cells_data):
+		# score the whole block at once, then pick tiles in order so usage limits apply exactly as cell-by-cell
+		self.stats['possible_comparisons'] += len(cells_data) * len(self.tiles_array)
+		if not CANDIDATE_COUNT or CANDIDATE_COUNT >= len(self.tiles_array):
+			self.stats['full_comparisons'] += len(cells_data) * len(self.tiles_array)
+			return [self.choose_tile(diffs) for diffs in self.get_tile_diffs(cells_data)]
+
+		candidates, candidate_diffs = self.get_candidate_diffs(cells_data)
+		audited = self.rng.random(len(candidates)) < CANDIDATE_AUDIT_RATE
+		self.stats['full_comparisons'] += candidates.size + int(np.count_nonzero(audited)) * len(self.tiles_array)
+		best_fit_tile_indexes = []
+		for i in range(len(candidates)):
+			audit_diffs = self.get_tile_diffs(cells_data[i:i + 1])[0] if audited[i] else None
+			tile_index = self.choose_tile(candidate_diffs[i], candidates[i], audit_diffs)
+			if tile_index is None:
+				# every candidate got used up in the meantime, so search all the tiles for this cell
+				self.stats['candidate_fallbacks'] += 1
+				self.stats['full_comparisons'] += len(self.tiles_array)
+				tile_index = self.choose_tile(self.get_tile_diffs(cells_data[i:i + 1])[0])
+			best_fit_tile_indexes.append(tile_index)
+		return best_fit_tile_indexes
+
+	def get_best_fit_tile(self, img_data):
+		return self.get_best_fit_tiles([img_data])[0]
+
+def create_shared_array(array):
+	# copies array into a new shared memory block, the returned spec lets other processes map it without a copy
+	memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+	np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)[:] = array
+	return (memory, (memory.name, array.shape, array.dtype.str))
+
+def attach_shared_array(spec):
+	# the returned SharedMemory has to be kept around for as long as the array is used, it unmaps the block when
+	# it gets garbage collected
+	name, shape, dtype = spec
+	memory = shared_memory.SharedMemory(name=name)
+	return (memory, np.ndarray(shape, dtype=dtype, buffer=memory.buf))
+
+def fit_tiles(work_queue, result_queue, tiles_spec, cells_spec, file_sizes, used_tile_counts, average_colors, settings):
+	# this function gets run by the worker processes, one on each CPU core. The tiles and the cells are mapped from
+	# shared memory, the work queue only carries ranges of cell indexes
+	configure(**settings)
+	profile = start_cprofile(PROFILE and PROFILE_CPROFILE)
+	tiles_memory, tiles_array = attach_shared_array(tiles_spec)
+	cells_memory, cells = attach_shared_array(cells_spec)
+	tile_fitter = TileFitter(tiles_array, file_sizes, used_tile_counts, average_colors)
+	profiler = StageProfiler()
+	num_cells = 0
 
 	while True:
 		try:
-			img_data, img_coords = work_queue.get(True)
-			if img_data == EOQ_VALUE:
+			with profiler.stage('waiting for work'):
+				start, end = work_queue.get(True)
+			if start == EOQ_VALUE:
 				break
-			tile_index = tile_fitter.get_best_fit_tile(img_data)
-			result_queue.put((img_coords, tile_index))
+			with profiler.stage('matching'):
+				tile_fitter.seed(start)
+				tile_indexes = tile_fitter.get_best_fit_tiles(cells[start:end])
+			num_cells += len(tile_indexes)
+			# one message per range, the builder looks the boxes up by cell index
+			result_queue.put((start, tile_indexes))
 		except KeyboardInterrupt:
 			pass
 
-	# let the result handler know that this worker has finished everything
-	result_queue.put((EOQ_VALUE, EOQ_VALUE))
+	dump_cprofile(profile, PROFILE_REPORT_FILE, 'worker')
+	# let the result handler know that this worker has finished everything, along with its matching stats
+	result_queue.put((EOQ_VALUE, dict(tile_fitter.stats, pid=os.getpid(), cells=num_cells, stages=profiler.stages)))
 
 class ProgressCounter:
 	def __init__(self, total):
 		self.total = total
 		self.counter = 0
 
-	def update(self):
-		self.counter += 1
+	def update(self, count=1):
+		self.counter += count
 		print("Progress: {:04.1f}%".format(100 * self.counter / self.total), flush=True, end='\r')
 
 class MosaicImage:
-	def __init__(self, original_img):
-		self.image = Image.new(original_img.mode, original_img.size)
-		self.x_tile_count = int(original_img.size[0] / TILE_SIZE)
-		self.y_tile_count = int(original_img.size[1] / TILE_SIZE)
+	def __init__(self, size):
+		# the mosaic is assembled in one contiguous uint8 array and only becomes an image when it gets saved. Above
+		# CANVAS_MEMORY_MB the array is mapped from a temporary file, so the os can page it out
+		shape = (size[1], size[0], 3)
+		if shape[0] * shape[1] * 3 > CANVAS_MEMORY_MB * 1024 * 1024:
+			self.canvas = np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode='w+', shape=shape)
+		else:
+			self.canvas = np.zeros(shape, dtype=np.uint8)
+		self.x_tile_count = int(size[0] / TILE_SIZE)
+		self.y_tile_count = int(size[1] / TILE_SIZE)
 		self.total_tiles  = self.x_tile_count * self.y_tile_count
 
 	def add_tile(self, tile_data, coords):
-		img = Image.new('RGB', (TILE_SIZE, TILE_SIZE))
-		img.putdata(tile_data)
-		self.image.paste(img, coords)
+		x, y = coords[0], coords[1]
+		self.canvas[y:y + TILE_SIZE, x:x + TILE_SIZE] = tile_data
+
+	def get_bands(self, path):
+		# (path, top, bottom) of every file the mosaic is saved to. A mosaic over CANVAS_MEMORY_MB is split into bands
+		# of whole tile rows that each fit, saved as mosaic-0.jpeg, mosaic-1.jpeg...
+		height = self.canvas.shape[0]
+		band_height = max(CANVAS_MEMORY_MB * 1024 * 1024 // (self.canvas.shape[1] * 3 * TILE_SIZE), 1) * TILE_SIZE
+		if band_height >= height:
+			return [(path, 0, height)]
+		root, ext = os.path.splitext(path)
+		return [('{}-{}{}'.format(root, i, ext), top, min(top + band_height, height)) for i, top in enumerate(range(0, height, band_height))]
 
 	def save(self, path):
-		self.image.save(path)
+		# returns the paths it saved to
+		bands = self.get_bands(path)
+		for band_path, top, bottom in bands:
+			Image.fromarray(np.asarray(self.canvas[top:bottom])).save(band_path)
+		return [band_path for band_path, _, _ in bands]
+
+	def load(self, path):
+		for band_path, top, bottom in self.get_bands(path):
+			self.canvas[top:bottom] = np.asarray(open_large_image(band_path).convert('RGB'))
 
 def get_scripts_from_slugs(content_base_url, slug_names):
 	script_info_str = ""
@@ -235,8 +653,97 @@ def get_scripts_from_slugs(content_base_url, slug_names):
 		color_concat_str += '.concat(' + color_name + ')'
 	script_info_str += '<script>\n' + concat_str + ';\n' + color_concat_str + ';\n</script>\n'
 	return script_info_str
-def generate_html(ordered_id_nums, file_name, content_base_url, image_title, slug_names):
-	script_info_str = get_scripts_from_slugs(content_base_url, slug_names)
+# decodes the base64 encodings of orderedIdNums: little-endian integers of `width` bytes, the largest one standing
+# for an empty cell (-1), or for width 0 the differences between consecutive numbers as zigzag varints
+ID_NUMS_DECODER_JS = """
+const decodeIdNums = (data, width) => {
+    const bytes = Uint8Array.from(atob(data), c => c.charCodeAt(0))
+    const nums = []
+    let n = 0, shift = 0, prev = 0
+    for (let i = 0; i < bytes.length; i++) {
+        if (width) {
+            n += bytes[i] * 2 ** (8 * (i % width))
+            if (i % width < width - 1) continue
+        } else {
+            n += (bytes[i] & 127) * 2 ** shift
+            shift += 7
+            if (bytes[i] & 128) continue
+            n = prev += n % 2 ? -(n + 1) / 2 : n / 2
+        }
+        nums.push(width && n === 2 ** (8 * width) - 1 ? -1 : n)
+        n = shift = 0
+    }
+    return nums
+}
+"""
+
+def encode_id_nums(ordered_id_nums, encoding):
+	# returns the javascript expression that evaluates to orderedIdNums in the given encoding
+	if encoding == 'json':
+		return json.dumps(ordered_id_nums)
+	if encoding == 'base64':
+		# the largest number of the width is kept for the empty cells
+		width = max(1, ((max(ordered_id_nums, default=0) + 1).bit_length() + 7) // 8)
+		empty = 2 ** (8 * width) - 1
+		data = b''.join((empty if n < 0 else n).to_bytes(width, 'little') for n in ordered_id_nums)
+	elif encoding == 'base64-delta':
+		width = 0
+		data = bytearray()
+		prev = 0
+		for n in ordered_id_nums:
+			delta = n - prev
+			prev = n
+			zigzag = 2 * delta if delta >= 0 else -2 * delta - 1
+			while zigzag >= 128:
+				data.append(128 | (zigzag & 127))
+				zigzag >>= 7
+			data.append(zigzag)
+	else:
+		raise ValueError('Unknown orderedIdNums encoding: {}'.format(encoding))
+	return 'decodeIdNums("{}", {})'.format(base64.b64encode(bytes(data)).decode('ascii'), width)
+
+def decode_id_nums(expression):
+	# the inverse of encode_id_nums, for reading orderedIdNums back out of a generated mosaic
+	expression = expression.strip()
+	if expression.startswith('['):
+		return json.loads(expression)
+	data, width = re.match(r'decodeIdNums\("([^"]*)",\s*(\d+)\)', expression).groups()
+	data = base64.b64decode(data)
+	width = int(width)
+	if width:
+		nums = [int.from_bytes(data[i:i + width], 'little') for i in range(0, len(data), width)]
+		return [-1 if n == 2 ** (8 * width) - 1 else n for n in nums]
+	nums = []
+	n = shift = prev = 0
+	for byte in data:
+		n += (byte & 127) << shift
+		shift += 7
+		if byte & 128:
+			continue
+		prev += -(n + 1) // 2 if n % 2 else n // 2
+		nums.append(prev)
+		n = shift = 0
+	return nums
+
+def get_id_nums_encoding_sizes(ordered_id_nums):
+	# size in bytes of orderedIdNums in every encoding, including the decoder it needs
+	sizes = {}
+	for encoding in ID_NUMS_ENCODINGS:
+		sizes[encoding] = len(encode_id_nums(ordered_id_nums, encoding))
+		if encoding != 'json':
+			sizes[encoding] += len(ID_NUMS_DECODER_JS)
+	return sizes
+
+def get_id_nums_encoding(ordered_id_nums):
+	if ID_NUMS_ENCODING != 'auto':
+		return ID_NUMS_ENCODING
+	sizes = get_id_nums_encoding_sizes(ordered_id_nums)
+	return min(sizes, key=sizes.get)
+
+def get_html(script_info_str, id_nums_str, id_nums_decoder_str, content_base_url, image_title, template):
+	# the page of a mosaic in the given HTML_TEMPLATE, around the scripts that load the collections and orderedIdNums
+	if template not in HTML_TEMPLATES:
+		raise ValueError('Unknown html template: {}'.format(template))
 	img_vw = 100 / NUM_TILES_PER_ROW
 	html = """
 <!DOCTYPE html>
@@ -252,7 +759,7 @@ body {
 background-color:black;
 text-align:center;
 }
-img, .preview {
+""" + ("""img, .preview {
 margin:0;
 padding:0;
 border:none;
@@ -264,16 +771,109 @@ margin:0;
 padding:0;
 width:100vw;
 }
-</style>
+""" if template == 'dom' else """canvas {
+display:block;
+margin:auto;
+cursor:pointer;
+}
+""") + """</style>
 </head>
 <body>""" + script_info_str + """
 <script>
-const SIZE=""" + str(NUM_TILES_PER_ROW) + """
-const orderedIdNums = """ + json.dumps(ordered_id_nums) + '''
+const SIZE=""" + str(NUM_TILES_PER_ROW) + id_nums_decoder_str + """
+const orderedIdNums = """ + id_nums_str + '''
 const urlParams = new Proxy(new URLSearchParams(window.location.search), {
     get: (searchParams, prop) => searchParams.get(prop),
 });
-let PREVIEW_WINDOW_WIDTH = 500
+'''
+	if template == 'canvas':
+		# one canvas painted with the colors first. Every inscription is fetched once and drawn into all its cells,
+		# at most maxRequests at a time, the ones of the rows in view first
+		return html + '''const MAX_REQUESTS = parseInt(urlParams.maxRequests) || ''' + str(CANVAS_MAX_REQUESTS) + '''
+const ROWS = Math.ceil(orderedIdNums.length / SIZE)
+const TILE = parseInt(urlParams.tileSize) || Math.max(8, Math.ceil(window.innerWidth * (window.devicePixelRatio || 1) / SIZE))
+const canvas = document.createElement('canvas')
+canvas.id = 'mosaic'
+canvas.width = TILE * SIZE
+canvas.height = TILE * ROWS
+canvas.style.width = urlParams.tileSize ? canvas.width + 'px' : '100vw'
+document.body.appendChild(canvas)
+const context = canvas.getContext('2d')
+const getUrl = idNum => "''' + content_base_url + '''" + "/content/" + inscriptionIds[idNum]
+// the cells of every inscription, and the inscriptions of every row
+const cells = new Map()
+const rows = []
+for (let i = 0; i < orderedIdNums.length; i++) {
+    const idNum = orderedIdNums[i]
+    const row = Math.floor(i / SIZE)
+    rows[row] = rows[row] || []
+    // -1 marks a cell no tile could be placed in, it stays black
+    if (idNum < 0) continue
+    context.fillStyle = 'rgb(' + colors[idNum].join(',') + ')'
+    context.fillRect(i % SIZE * TILE, row * TILE, TILE, TILE)
+    if (!cells.has(idNum)) cells.set(idNum, [])
+    cells.get(idNum).push(i)
+    rows[row].push(idNum)
+}
+const requested = new Set()
+let numLoading = 0
+let numItemsLoaded = 0
+const nextIdNum = () => {
+    // the first inscription not requested yet, from the top row in view down and then the rows above it
+    const rect = canvas.getBoundingClientRect()
+    const firstRow = Math.min(Math.max(Math.floor(-rect.top / rect.height * ROWS), 0), ROWS - 1)
+    for (let r = 0; r < ROWS; r++) {
+        const row = rows[(firstRow + r) % ROWS]
+        while (row.length) {
+            const idNum = row.shift()
+            if (!requested.has(idNum)) return idNum
+        }
+    }
+}
+const loadTiles = () => {
+    while (numLoading < MAX_REQUESTS) {
+        const idNum = nextIdNum()
+        if (idNum === undefined) return
+        requested.add(idNum)
+        numLoading++
+        const img = new Image()
+        const onDone = () => {
+            numLoading--
+            numItemsLoaded++
+            if (numItemsLoaded === cells.size && urlParams.download) {
+                window.downloadImage()
+            }
+            loadTiles()
+        }
+        img.onload = () => {
+            for (const i of cells.get(idNum)) {
+                context.drawImage(img, i % SIZE * TILE, Math.floor(i / SIZE) * TILE, TILE, TILE)
+            }
+            onDone()
+        }
+        // the cells keep their color
+        img.onerror = onDone
+        img.src = getUrl(idNum)
+    }
+}
+window.downloadImage = () => {
+    const link = document.createElement('a');
+    link.href = canvas.toDataURL('image/png');
+    link.download = "''' + image_title.replace(' ', '-') + '''.png";
+    link.click();
+}
+canvas.onclick = event => {
+    const rect = canvas.getBoundingClientRect()
+    const i = Math.floor((event.clientY - rect.top) / rect.height * ROWS) * SIZE + Math.floor((event.clientX - rect.left) / rect.width * SIZE)
+    if (orderedIdNums[i] >= 0) window.open(getUrl(orderedIdNums[i]))
+}
+loadTiles()
+</script>
+</body>
+</html>
+
+'''
+	return html + '''let PREVIEW_WINDOW_WIDTH = 500
 if (urlParams.previewWindowWidth) {
     PREVIEW_WINDOW_WIDTH = parseInt(urlParams.previewWindowWidth) || PREVIEW_WINDOW_WIDTH
 }
@@ -296,13 +896,13 @@ const imgs = []
 window.downloadImage = () => {
     const canvas = document.createElement('canvas');
     const context = canvas.getContext('2d');
-    const imageSize = imgs[0].width
+    const imageSize = imgs.find(img => img).width
     canvas.width = imageSize * SIZE;
-    canvas.height = imageSize * SIZE;
+    canvas.height = imageSize * Math.ceil(imgs.length / SIZE);
     for (let i = 0; i < imgs.length; i++) {
         const x = Math.floor(i / SIZE)
         const y = i % SIZE
-        context.drawImage(imgs[i], y * imageSize, x * imageSize, imageSize, imageSize);
+        if (imgs[i]) context.drawImage(imgs[i], y * imageSize, x * imageSize, imageSize, imageSize);
     }
     const link = document.createElement('a');
     link.href = canvas.toDataURL('image/png');
@@ -313,13 +913,16 @@ window.downloadImage = () => {
 const mosaicElement = document.createElement('div')
 mosaicElement.id = 'mosaic'
 document.body.appendChild(mosaicElement)
+// -1 marks a cell no tile could be placed in, it stays black
+const numTiles = orderedIdNums.filter(idNum => idNum >= 0).length
 for (let i = 0; i < orderedIdNums.length; i++) {
     if (i % SIZE === 0) {
         currentDiv = document.createElement('div')
         currentDiv.className = "row"
     }
+    const isEmpty = orderedIdNums[i] < 0
     const inscriptionId = inscriptionIds[orderedIdNums[i]]
-    const rgbColor = colors[orderedIdNums[i]]
+    const rgbColor = isEmpty ? [0, 0, 0] : colors[orderedIdNums[i]]
 	const url = "''' + content_base_url + '''" + "/content/" + inscriptionId
     const openInscription = () => window.open(url)
     const previewElement = document.createElement('div')
@@ -332,12 +935,14 @@ for (let i = 0; i < orderedIdNums.length; i++) {
     }
     imgElement.onload = () => {
         numItemsLoaded++
-        if (numItemsLoaded === orderedIdNums.length && urlParams.download) {
+        if (numItemsLoaded === numTiles && urlParams.download) {
             window.downloadImage()
         }
     }
     let tileDiv
-    if (SHOW_PREVIEW) {
+    if (isEmpty) {
+        tileDiv = previewElement
+    } else if (SHOW_PREVIEW) {
         previewElement.style.visibility = 'hidden'
         previewElement.onclick = () => {
             imgElement.src = url
@@ -349,7 +954,7 @@ for (let i = 0; i < orderedIdNums.length; i++) {
         imgElement.src = url
         tileDiv = imgElement
     }
-    imgs.push(imgElement)
+    imgs.push(isEmpty ? null : imgElement)
     currentDiv.appendChild(tileDiv)
     if (i % SIZE === SIZE - 1) {
         mosaicElement.appendChild(currentDiv)
@@ -360,143 +965,452 @@ for (let i = 0; i < orderedIdNums.length; i++) {
 </html>
 
 '''
+
+def generate_html(ordered_id_nums, file_name, content_base_url, image_title, slug_names):
+	script_info_str = get_scripts_from_slugs(content_base_url, slug_names)
+	id_nums_encoding = get_id_nums_encoding(ordered_id_nums)
+	id_nums_decoder_str = '' if id_nums_encoding == 'json' else ID_NUMS_DECODER_JS
+	html = get_html(script_info_str, encode_id_nums(ordered_id_nums, id_nums_encoding), id_nums_decoder_str, content_base_url, image_title, HTML_TEMPLATE)
 	f = open(file_name, 'w')
 	f.write(html)
 	print('Wrote output html to', file_name)
-def build_mosaic(result_queue, all_tile_data_large, original_img_large, file_names, file_sizes, average_colors, image_title, slug_names):
-	mosaic = MosaicImage(original_img_large)
-	used_file_names_with_coords_and_sizes = []
-	active_workers = WORKER_COUNT
-	while True:
+
+def get_html_runtime_bytes(template):
+	# size of the page of a mosaic without its scripts, title and orderedIdNums
+	return len(get_html('', '[]', '', '', '', template))
+def build_mosaic(result_queue, tile_paths, mosaic_size, cell_boxes, file_sizes, image_title, slug_names, start_time, worker_count, settings, result_cache=None):
+	configure(**settings)
+	profile = start_cprofile(PROFILE and PROFILE_CPROFILE)
+	profiler = StageProfiler()
+	result_queue_depth = QueueDepthSampler(result_queue, start_time)
+	mosaic = MosaicImage(mosaic_size)
+	if PREVIEW:
+		# refine the preview mosaic() wrote
+		mosaic.load(OUT_FILE)
+		last_refresh_time = time.time()
+	progress = ProgressCounter(mosaic.total_tiles)
+	large_tiles = {}
+	# the tile of every cell in the order of cell_boxes, -1 for none
+	placed_tile_indexes = np.full(len(cell_boxes), -1)
+	active_workers = worker_count
+	worker_stats = []
+	main_stats = None
+	matching_start_wall = time.perf_counter()
+	while active_workers or main_stats is None:
 		try:
-			img_coords, best_fit_tile_index = result_queue.get()
+			result_queue_depth.sample()
+			start, tile_indexes = result_queue.get()
 
-			if img_coords == EOQ_VALUE:
+			if start == EOQ_VALUE:
+				# the workers send their matching stats along with the end of queue marker
+				worker_stats.append(tile_indexes)
 				active_workers -= 1
-				if not active_workers:
-					break
+			elif start == MAIN_STATS_VALUE:
+				main_stats = tile_indexes
 			else:
-				tile_data = all_tile_data_large[best_fit_tile_index]
-				mosaic.add_tile(tile_data, img_coords)
-				# print(best_fit_tile_index)
-				# print(file_names[best_fit_tile_index])
-				used_file_names_with_coords_and_sizes.append((file_names[best_fit_tile_index], img_coords, file_sizes[best_fit_tile_index], best_fit_tile_index))
+				for img_coords, best_fit_tile_index in zip(cell_boxes[start:start + len(tile_indexes)], tile_indexes):
+					if best_fit_tile_index is None:
+						if PREVIEW:
+							# the cell stays empty, like it would without the preview
+							mosaic.add_tile(0, img_coords)
+						continue
+					if best_fit_tile_index not in large_tiles:
+						with profiler.stage('large tile decode'):
+							large_tiles[best_fit_tile_index] = load_large_tile(tile_paths[best_fit_tile_index])
+					with profiler.stage('paste'):
+						mosaic.add_tile(large_tiles[best_fit_tile_index], img_coords)
+				placed_tile_indexes[start:start + len(tile_indexes)] = [-1 if tile_index is None else tile_index for tile_index in tile_indexes]
+				progress.update(len(tile_indexes))
+				if PREVIEW and time.time() - last_refresh_time > PREVIEW_REFRESH_SECONDS:
+					with profiler.stage('save'):
+						mosaic.save(OUT_FILE)
+					last_refresh_time = time.time()
 
 		except KeyboardInterrupt:
 			pass
+	matching_wall_seconds = time.perf_counter() - matching_start_wall
+	match_stats = {}
+	for stats in worker_stats:
+		for key, value in stats.items():
+			if isinstance(value, int) and key != 'pid':
+				match_stats[key] = match_stats.get(key, 0) + value
+
+	print()
+	write_outputs(mosaic, cell_boxes, placed_tile_indexes, tile_paths, file_sizes, image_title, slug_names, '', profiler)
+	# an interrupted run leaves cells out
+	if result_cache is not None and progress.counter == len(cell_boxes):
+		result_cache.put(cell_boxes, placed_tile_indexes)
+	if match_stats.get('audited_cells'):
+		print('Candidate search picked a different tile than the exhaustive search for {} of {} audited cells ({:.1f}%), {} cells fell back to the exhaustive search'.format(
+			match_stats['audit_mismatches'], match_stats['audited_cells'], 100 * match_stats['audit_mismatches'] / match_stats['audited_cells'], match_stats['candidate_fallbacks']))
+	dump_cprofile(profile, PROFILE_REPORT_FILE, 'build')
+	if PROFILE:
+		write_profile_report(main_stats, profiler, worker_stats, match_stats, matching_wall_seconds, result_queue_depth.samples)
 
-	mosaic.save(OUT_FILE)
-	print('\nFinished, wrote output jpeg to', OUT_FILE)
-	used_file_names_with_coords_and_sizes.sort(key=lambda a: (a[1][1], a[1][0]))
-	ordered_file_names = [x[0] for x in used_file_names_with_coords_and_sizes]
-	ordered_file_sizes = [x[2] for x in used_file_names_with_coords_and_sizes]
-	ordered_id_nums = [x[3] for x in used_file_names_with_coords_and_sizes]
-	position_dict = {}
-	total_downloaded_bytes = 0
-	for i in range(len(ordered_file_names)):
-		file_name = ordered_file_names[i]
-		if file_name not in position_dict:
-			# position_dict[file_name] = { "p":[], "c": [ordered_colors[i][0], ordered_colors[i][1], ordered_colors[i][2]] }
-			position_dict[file_name] = True
-			total_downloaded_bytes += ordered_file_sizes[i]
-		# position_dict[file_name]["p"].append(i)
-
-	generate_html(ordered_id_nums, "preview-do-not-inscribe.html", "https://ordinals.com", image_title, slug_names)
-	generate_html(ordered_id_nums, "mosaic.html", "", image_title, slug_names)
-	num_unique_tiles = len(position_dict)
+def write_outputs(mosaic, cell_boxes, tile_indexes, tile_paths, file_sizes, image_title, slug_names, output_dir='', profiler=None):
+	# saves the mosaic jpeg and both html files to output_dir and returns the stats of the mosaic. tile_indexes has
+	# the tile of every cell in cell_boxes, -1 for the cells left empty
+	profiler = profiler or StageProfiler()
+	with profiler.stage('save'):
+		out_files = mosaic.save(os.path.join(output_dir, OUT_FILE))
+	print('Finished, wrote output jpeg to', ', '.join(out_files))
+	placed = np.flatnonzero(tile_indexes >= 0)
+	tile_id_nums = get_tile_id_nums(tile_paths, slug_names)
+	if (tile_id_nums[tile_indexes[placed]] < 0).any():
+		raise ValueError('Some tiles are not in the ids files of {}'.format(','.join(slug_names)))
+	# row by row, left to right, with -1 for the empty cells so that the html keeps every tile in its place
+	cell_id_nums = np.full(len(tile_indexes), -1)
+	cell_id_nums[placed] = tile_id_nums[tile_indexes[placed]]
+	ordered_id_nums = cell_id_nums[np.lexsort((cell_boxes[:, 0], cell_boxes[:, 1]))].tolist()
+	num_empty_cells = len(tile_indexes) - len(placed)
+	if num_empty_cells:
+		print('Warning: {} cells have no tile, they are left black'.format(num_empty_cells))
+	unique_tile_indexes = np.unique(tile_indexes[placed])
+	total_downloaded_bytes = int(np.asarray(file_sizes, dtype=np.int64)[unique_tile_indexes].sum())
+
+	with profiler.stage('html'):
+		generate_html(ordered_id_nums, os.path.join(output_dir, PREVIEW_HTML_OUT_FILE), "https://ordinals.com", image_title, slug_names)
+		generate_html(ordered_id_nums, os.path.join(output_dir, HTML_OUT_FILE), "", image_title, slug_names)
+	num_unique_tiles = len(unique_tile_indexes)
 	print('Number of unique tiles:', num_unique_tiles)
+	encoding_sizes = get_id_nums_encoding_sizes(ordered_id_nums)
+	print('orderedIdNums bytes by encoding:', ', '.join('{} {}'.format(encoding, size) for encoding, size in encoding_sizes.items()),
+		'(using {})'.format(get_id_nums_encoding(ordered_id_nums)))
 	print('Number of download bytes required:', total_downloaded_bytes)
+	return {
+		'cells': len(ordered_id_nums),
+		'empty_cells': num_empty_cells,
+		'unique_tiles': num_unique_tiles,
+		'download_bytes': total_downloaded_bytes,
+		'id_nums_encoding': get_id_nums_encoding(ordered_id_nums),
+		'id_nums_bytes': encoding_sizes,
+		# mosaic.jpeg, or mosaic-0.jpeg, mosaic-1.jpeg... when the canvas is over CANVAS_MEMORY_MB
+		'jpeg_files': out_files,
+	}
+
+def write_profile_report(main_stats, build_profiler, worker_stats, match_stats, matching_wall_seconds, result_queue_depth):
+	stages = StageProfiler()
+	stages.merge(main_stats['stages'])
+	stages.add('matching (until all workers finished)', matching_wall_seconds, 0)
+	stages.merge(build_profiler.stages)
+	workers = []
+	for stats in worker_stats:
+		matching = stats['stages'].get('matching', {'wall_seconds': 0, 'cpu_seconds': 0})
+		workers.append({
+			'pid': stats['pid'],
+			'cells': stats['cells'],
+			'matching_wall_seconds': matching['wall_seconds'],
+			'matching_cpu_seconds': matching['cpu_seconds'],
+			'waiting_seconds': stats['stages'].get('waiting for work', {}).get('wall_seconds', 0),
+			'cells_per_second': stats['cells'] / matching['wall_seconds'] if matching['wall_seconds'] else None,
+		})
+	picks = match_stats.get('picks', 0)
+	possible_comparisons = match_stats.get('possible_comparisons', 0)
+	write_report(PROFILE_REPORT_FILE, {
+		'settings': {
+			'NUM_TILES_PER_ROW': NUM_TILES_PER_ROW, 'TILE_SIZE': TILE_SIZE, 'TILE_MATCH_RES': TILE_MATCH_RES, 'REPEAT': REPEAT,
+			'MAX_OCCURRENCES_PER_TILE': MAX_OCCURRENCES_PER_TILE, 'WORKER_COUNT': WORKER_COUNT, 'MATCH_BLOCK_SIZE': MATCH_BLOCK_SIZE,
+			'CANDIDATE_COUNT': CANDIDATE_COUNT,
+		},
+		'stages': stages.stages,
+		'workers': workers,
+		'matching': dict(match_stats,
+			# average number of tiles the usage rules ruled out per pick, what should_skip used to skip
+			skipped_tiles_per_pick=match_stats.get('skipped_tiles', 0) / picks if picks else None,
+			# share of cell x tile comparisons the candidate shortlist avoided, what the early bail used to save
+			comparisons_avoided_rate=1 - match_stats.get('full_comparisons', 0) / possible_comparisons if possible_comparisons else None),
+		'work_queue_depth': main_stats['work_queue_depth'],
+		'result_queue_depth': result_queue_depth,
+	})
+
+def get_cell_order(cell_boxes):
+	# the order the cells get matched in. Random, or with RANDOM_RANGE outwards from the middle of the mosaic with
+	# every distance jittered by up to RANDOM_RANGE tiles
+	rng = get_rng(0)
+	if RANDOM_RANGE <= 0:
+		return rng.permutation(len(cell_boxes))
+	points = cell_boxes[:, :2] // TILE_SIZE
+	middle = (points.max(axis=0) + 1) // 2
+	jitter = rng.integers(0, RANDOM_RANGE + 1, points.shape) - rng.integers(0, RANDOM_RANGE + 1, points.shape)
+	distances = np.hypot(*(points + jitter - middle).T)
+	return np.argsort(distances, kind='stable')
+
+def get_cell_boxes(x_tile_count, y_tile_count):
+	# the box of every cell in the mosaic as an (N_cells x 4) array, column by column
+	x, y = np.divmod(np.arange(x_tile_count * y_tile_count), y_tile_count)
+	return np.stack([x * TILE_SIZE, y * TILE_SIZE, (x + 1) * TILE_SIZE, (y + 1) * TILE_SIZE], axis=1)
 
-def calculate_distance(point1, point2):
-	x1, y1 = point1
-	x2, y2 = point2
-	x1 += random.randint(0, RANDOM_RANGE)
-	y1 += random.randint(0, RANDOM_RANGE)
-	x2 += random.randint(0, RANDOM_RANGE)
-	y2 += random.randint(0, RANDOM_RANGE)
-	return math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
+def get_target_cells(original_img_small, x_tile_count, y_tile_count):
+	# returns the pixels of every cell of the target image as one (N_cells x TILE_MATCH_RES_PX x TILE_MATCH_RES_PX x 3)
+	# array and the boxes of the cells, in the same order
+	px = TILE_MATCH_RES_PX
+	img = np.asarray(original_img_small)[:y_tile_count * px, :x_tile_count * px]
+	cells = img.reshape(y_tile_count, px, x_tile_count, px, 3).transpose(2, 0, 1, 3, 4).reshape(-1, px, px, 3)
+	return (cells, get_cell_boxes(x_tile_count, y_tile_count))
 
-def sort_queue_items(queue_items, reference_point):
-	return sorted(queue_items, key=lambda item: calculate_distance(reference_point, (item[2], item[3])))
+def get_ordered_cells(original_img_small, mosaic):
+	cells, cell_boxes = get_target_cells(original_img_small, mosaic.x_tile_count, mosaic.y_tile_count)
+	order = get_cell_order(cell_boxes)
+	return (cells[order], cell_boxes[order])
+
+def assign_tiles(cells_data, tiles_data, file_sizes, average_colors):
+	# PLACEMENT = 'assignment': solve for the tiles of all the cells at once, see assignment.py. The greedy placement
+	# runs first, its picks are always among the candidates so the assignment can only do better
+	cells = np.asarray(cells_data, dtype=np.float64).reshape(len(cells_data), -1)
+	tiles = tiles_data.reshape(len(tiles_data), -1).astype(np.float64)
+	tile_fitter = TileFitter(tiles_data, file_sizes, None, average_colors)
+	order = get_rng(2).permutation(len(cells_data))
+	greedy_tile_indexes = np.full(len(cells_data), -1)
+	for i in range(0, len(order), MATCH_BLOCK_SIZE):
+		block = order[i:i + MATCH_BLOCK_SIZE]
+		tile_fitter.seed(i)
+		greedy_tile_indexes[block] = [-1 if tile_index is None else tile_index for tile_index in tile_fitter.get_best_fit_tiles(cells_data[block])]
+	greedy_errors = get_assignment_errors(cells, tiles, greedy_tile_indexes)
+	greedy_unique_tiles = len(np.unique(greedy_tile_indexes[greedy_tile_indexes >= 0]))
+	greedy_repeats = np.count_nonzero(greedy_tile_indexes >= 0) - greedy_unique_tiles
+
+	if REPEAT in ['STRICT_NO', 'MINIMIZED']:
+		capacity, repeat_penalty = 1, 0
+	elif REPEAT == 'ALL_INCLUDED':
+		# an extra repeat costs more than the whole greedy placement, so no more tiles get repeated than in that one
+		capacity, repeat_penalty = MAX_OCCURRENCES_PER_TILE, greedy_errors.sum() + 1
+	else:
+		capacity, repeat_penalty = MAX_OCCURRENCES_PER_TILE, ASSIGNMENT_REPEAT_PENALTY
+	# the greedy placement only leaves cells empty once the tiles are used up, and those cells stay empty. If they
+	# took part, the cells would bid up the scarce slots in a long price war over which of them get left out
+	placed_cells = np.flatnonzero(greedy_tile_indexes >= 0)
+	tile_indexes = greedy_tile_indexes
+	stats = {'assignment_rounds': 0, 'assignment_edges': 0}
+	if len(placed_cells):
+		offsets, edge_tiles, edge_costs = get_candidate_edges(cells[placed_cells], tiles, ASSIGNMENT_CANDIDATES,
+			required_tiles=greedy_tile_indexes[placed_cells], required_costs=greedy_errors[placed_cells])
+		# leaving out a cell the greedy placement could place costs more than the whole greedy placement
+		auction = TileAuction(offsets, edge_tiles, edge_costs, len(tiles), capacity, repeat_penalty, greedy_errors.sum() + greedy_repeats * repeat_penalty + 1)
+		placed_tile_indexes = auction.solve(max_rounds=ASSIGNMENT_MAX_ROUNDS)
+		stats = {'assignment_rounds': auction.rounds, 'assignment_edges': len(edge_tiles), 'assignment_gave_up': placed_tile_indexes is None}
+		if placed_tile_indexes is None:
+			print('Assignment gave up after {} rounds, keeping the greedy placement'.format(auction.rounds))
+		else:
+			tile_indexes = np.full(len(cells_data), -1)
+			tile_indexes[placed_cells] = placed_tile_indexes
 
-def compose(original_img, tiles, image_title, slug_names):
+	error = get_assignment_errors(cells, tiles, tile_indexes).sum()
+	print('Assignment placed {} cells with {} unique tiles, total error {:.6g} ({:.1f}% lower than the greedy placement with {} unique tiles, {:.6g})'.format(
+		np.count_nonzero(tile_indexes >= 0), len(np.unique(tile_indexes[tile_indexes >= 0])), error,
+		100 * (1 - error / greedy_errors.sum()) if greedy_errors.sum() else 0, greedy_unique_tiles, greedy_errors.sum()))
+	return (tile_indexes, stats)
+
+def compose(original_img, tiles, image_title, slug_names, profiler=None, result_cache=None):
 	print('Building mosaic, press Ctrl-C to abort...')
-	original_img_large, original_img_small = original_img
-	tiles_large, tiles_small, file_names, file_sizes, average_colors = tiles
+	profiler = profiler or StageProfiler()
+	start_time = time.time()
+	mosaic_size, original_img_small = original_img
+	tile_paths, tiles_small, file_names, file_sizes, average_colors = tiles
 	# print(file_names[0])
-	mosaic = MosaicImage(original_img_large)
-
-	all_tile_data_large = [list(tile.getdata()) for tile in tiles_large]
-	all_tile_data_small = [list(tile.getdata()) for tile in tiles_small]
+	mosaic = MosaicImage(mosaic_size)
 
 	work_queue   = Queue(WORKER_COUNT)	
 	result_queue = Queue()
+	used_tile_counts = Array('q', len(tiles_small))
+	work_queue_depth = QueueDepthSampler(work_queue, start_time)
+	# the assignment, and the greedy placement with SEED, run in this process and hand their results to the builder
+	# like one more worker would
+	worker_count = WORKER_COUNT if PLACEMENT == 'greedy' and SEED is None else 0
+	processes = []
+	shared_memories = []
 
 	try:
+		with profiler.stage('cell extraction'):
+			cells, cell_boxes = get_ordered_cells(original_img_small, mosaic)
+			cells = get_match_features(cells)
+
 		# start the worker processes that will build the mosaic image
-		Process(target=build_mosaic, args=(result_queue, all_tile_data_large, original_img_large, file_names, file_sizes, average_colors, image_title, slug_names)).start()
-
-		# start the worker processes that will perform the tile fitting
-		for n in range(WORKER_COUNT):
-			Process(target=fit_tiles, args=(work_queue, result_queue, all_tile_data_small, file_sizes)).start()
-
-		progress = ProgressCounter(mosaic.x_tile_count * mosaic.y_tile_count)
-		queue_items_with_coords = []
-		for x in range(mosaic.x_tile_count):
-			for y in range(mosaic.y_tile_count):
-				large_box = (x * TILE_SIZE, y * TILE_SIZE, (x + 1) * TILE_SIZE, (y + 1) * TILE_SIZE)
-				small_box = (x * TILE_SIZE/TILE_BLOCK_SIZE, y * TILE_SIZE/TILE_BLOCK_SIZE, (x + 1) * TILE_SIZE/TILE_BLOCK_SIZE, (y + 1) * TILE_SIZE/TILE_BLOCK_SIZE)
-				queue_items_with_coords.append((list(original_img_small.crop(small_box).getdata()), large_box, x, y))
-		# shuffle queue_items
-		if RANDOM_RANGE > 0:
-			queue_items_with_coords = sort_queue_items(queue_items_with_coords, (50, 50))
+		processes.append(Process(target=build_mosaic, args=(result_queue, tile_paths, mosaic_size, cell_boxes, file_sizes, image_title, slug_names, start_time, worker_count or 1, get_settings(), result_cache)))
+		processes[-1].start()
+
+		if PLACEMENT == 'assignment':
+			assignment_profiler = StageProfiler()
+			with assignment_profiler.stage('matching'):
+				tile_indexes, assignment_stats = assign_tiles(cells, get_match_features(tiles_small), file_sizes, get_match_colors(average_colors))
+			tile_indexes = [None if tile_index < 0 else int(tile_index) for tile_index in tile_indexes]
+			for i in range(0, len(tile_indexes), MATCH_BLOCK_SIZE):
+				result_queue.put((i, tile_indexes[i:i + MATCH_BLOCK_SIZE]))
+			result_queue.put((EOQ_VALUE, dict(assignment_stats, pid=os.getpid(), cells=len(tile_indexes), stages=assignment_profiler.stages)))
+		elif SEED is not None:
+			# the workers would pick tiles in whatever order they happen to finish, here every pick sees the usage
+			# counts of all the cells before it
+			matching_profiler = StageProfiler()
+			tile_fitter = TileFitter(get_match_features(tiles_small), file_sizes, None, get_match_colors(average_colors))
+			with matching_profiler.stage('matching'):
+				for start, tile_indexes in fit_tiles_in_order(tile_fitter, cells):
+					result_queue.put((start, tile_indexes))
+			result_queue.put((EOQ_VALUE, dict(tile_fitter.stats, pid=os.getpid(), cells=len(cells), stages=matching_profiler.stages)))
 		else:
-			random.shuffle(queue_items_with_coords)
-		for item in queue_items_with_coords:
-			work_queue.put((item[0], item[1]))
-			progress.update()
+			with profiler.stage('queue fill'):
+				# the workers map the tiles and the cells instead of getting a copy each, so memory stays flat as
+				# WORKER_COUNT grows. The tiles go in as float64 so TileFitter can use them without converting
+				tiles_memory, tiles_spec = create_shared_array(get_match_features(tiles_small).astype(np.float64))
+				shared_memories.append(tiles_memory)
+				cells_memory, cells_spec = create_shared_array(cells)
+				shared_memories.append(cells_memory)
+
+				# start the worker processes that will perform the tile fitting
+				for n in range(worker_count):
+					processes.append(Process(target=fit_tiles, args=(work_queue, result_queue, tiles_spec, cells_spec, file_sizes, used_tile_counts, get_match_colors(average_colors), get_settings())))
+					processes[-1].start()
+
+				# hand the cells to the workers as ranges so they can be scored together
+				for i in range(0, len(cells), MATCH_BLOCK_SIZE):
+					work_queue.put((i, min(i + MATCH_BLOCK_SIZE, len(cells))))
+					work_queue_depth.sample()
 
 	except KeyboardInterrupt:
 		print('\nHalting, saving partial image please wait...')
 
 	finally:
 		# put these special values onto the queue to let the workers know they can terminate
-		for n in range(WORKER_COUNT):
+		for n in range(len(processes) - 1):
 			work_queue.put((EOQ_VALUE, EOQ_VALUE))
+		result_queue.put((MAIN_STATS_VALUE, {'stages': profiler.stages, 'work_queue_depth': work_queue_depth.samples}))
+		# the shared memory can only go once every process is done with it
+		for process in processes:
+			process.join()
+		for memory in shared_memories:
+			memory.close()
+			memory.unlink()
+
+def fit_tiles_in_order(tile_fitter, cells_data):
+	# yields (start, tile indexes) for every MATCH_BLOCK_SIZE block of cells, matched one after the other
+	for start in range(0, len(cells_data), MATCH_BLOCK_SIZE):
+		tile_fitter.seed(start)
+		yield (start, tile_fitter.get_best_fit_tiles(cells_data[start:start + MATCH_BLOCK_SIZE]))
+
+def match_average_colors(cells_data, file_sizes, average_colors):
+	# the quick match of PREVIEW: the average colour of every cell against the average colour of the tiles, under
+	# the same REPEAT rules
+	cell_colors = cells_data.reshape(len(cells_data), -1, 3).mean(axis=1)
+	tile_fitter = TileFitter(average_colors, file_sizes, None, average_colors)
+	tile_indexes = []
+	for start, block_tile_indexes in fit_tiles_in_order(tile_fitter, cell_colors):
+		tile_indexes += block_tile_indexes
+	return tile_indexes
+
+def render_mosaic(original_img, tiles, image_title, slug_names, output_dir='', large_tiles=None, preview=False, tile_features=None, result_cache=None):
+	# renders a whole mosaic in the calling process and returns its stats, for batch.py and other callers that keep
+	# their own pool of processes. large_tiles and tile_features (get_match_features of the small tiles as float64)
+	# can be kept between calls with the same tiles, so each tile is decoded and converted once. With preview the
+	# cells are only matched on their average colour. With a result_cache the placement is reused if it has one
+	mosaic_size, original_img_small = original_img
+	tile_paths, tiles_small, file_names, file_sizes, average_colors = tiles
+	mosaic = MosaicImage(mosaic_size)
+	if result_cache is not None and not preview:
+		cell_boxes = get_cell_boxes(mosaic.x_tile_count, mosaic.y_tile_count)
+		cached_tile_indexes = result_cache.get(cell_boxes)
+		if cached_tile_indexes is not None:
+			print('Reusing the placement from', result_cache.path)
+			tile_indexes = [None if tile_index < 0 else int(tile_index) for tile_index in cached_tile_indexes]
+			return assemble_mosaic(mosaic, cell_boxes, tile_indexes, tiles, image_title, slug_names, output_dir, large_tiles)
+	cells, cell_boxes = get_ordered_cells(original_img_small, mosaic)
+
+	if tile_features is None and not preview:
+		tile_features = get_match_features(tiles_small).astype(np.float64)
+	if preview:
+		tile_indexes = match_average_colors(cells, file_sizes, average_colors)
+	elif PLACEMENT == 'assignment':
+		tile_indexes, assignment_stats = assign_tiles(get_match_features(cells), tile_features, file_sizes, get_match_colors(average_colors))
+		tile_indexes = [None if tile_index < 0 else int(tile_index) for tile_index in tile_indexes]
+	else:
+		cells = get_match_features(cells)
+		tile_fitter = TileFitter(tile_features, file_sizes, None, get_match_colors(average_colors))
+		tile_indexes = []
+		for start, block_tile_indexes in fit_tiles_in_order(tile_fitter, cells):
+			tile_indexes += block_tile_indexes
+	if result_cache is not None and not preview:
+		result_cache.put(cell_boxes, np.array([-1 if tile_index is None else tile_index for tile_index in tile_indexes]))
+	return assemble_mosaic(mosaic, cell_boxes, tile_indexes, tiles, image_title, slug_names, output_dir, large_tiles)
+
+def assemble_mosaic(mosaic, cell_boxes, tile_indexes, tiles, image_title, slug_names, output_dir='', large_tiles=None):
+	# pastes the tile of every cell, None for the empty ones, and writes the outputs
+	tile_paths, tiles_small, file_names, file_sizes, average_colors = tiles
+	large_tiles = {} if large_tiles is None else large_tiles
+	for img_coords, tile_index in zip(cell_boxes, tile_indexes):
+		if tile_index is None:
+			continue
+		if tile_index not in large_tiles:
+			large_tiles[tile_index] = load_large_tile(tile_paths[tile_index])
+		mosaic.add_tile(large_tiles[tile_index], img_coords)
+	tile_indexes = np.array([-1 if tile_index is None else tile_index for tile_index in tile_indexes])
+	return write_outputs(mosaic, cell_boxes, tile_indexes, tile_paths, file_sizes, image_title, slug_names, output_dir)
 
 def show_error(msg):
 	print('ERROR: {}'.format(msg))
 
-def mosaic(img_path, tiles_paths, image_title, slug_names):
-	image_data = TargetImage(img_path).get_data()
+def load_tiles(tiles_paths, profiler=None):
+	# processes the tiles of every directory and concatenates them, None when there are no tiles at all
+	profiler = profiler or StageProfiler()
 	tiles_data = ([], [], [], [], [])
-	for i in range(len(tiles_paths)):
-		tp = tiles_paths[i]
+	for tp in tiles_paths:
 		print('Processing tiles from {}...'.format(tp))
-		large_tiles, small_tiles, file_names, file_sizes, average_colors = TileProcessor(tp).get_tiles()
-		tiles_data[0].extend(large_tiles)
-		tiles_data[1].extend(small_tiles)
+		with profiler.stage('tile ingestion'):
+			tile_paths, small_tiles, file_names, file_sizes, average_colors = TileProcessor(tp).get_tiles()
+		tiles_data[0].extend(tile_paths)
+		tiles_data[1].append(small_tiles)
 		tiles_data[2].extend(file_names)
 		tiles_data[3].extend(file_sizes)
-		tiles_data[4].extend(average_colors)
-	if tiles_data[0]:
+		tiles_data[4].append(average_colors)
+	if not tiles_data[0]:
+		return None
+	return (tiles_data[0], np.concatenate(tiles_data[1]), tiles_data[2], tiles_data[3], np.concatenate(tiles_data[4]))
+
+def mosaic(img_path, tiles_paths, image_title, slug_names, **settings):
+	# settings are passed on to configure()
+	configure(**settings)
+	profile = start_cprofile(PROFILE and PROFILE_CPROFILE)
+	profiler = StageProfiler()
+	with profiler.stage('target resize'):
+		image_data = TargetImage(img_path, trusted=True).get_data()
+	tiles_data = load_tiles(tiles_paths, profiler)
+	if tiles_data is not None:
 		print(tiles_data[2][0])
-		compose(image_data, tiles_data, image_title, slug_names)
+		with open(img_path, 'rb') as f:
+			result_cache = get_result_cache(f.read(), slug_names)
+		if result_cache is not None and os.path.isfile(result_cache.path):
+			render_mosaic(image_data, tiles_data, image_title, slug_names, result_cache=result_cache)
+		else:
+			if PREVIEW:
+				with profiler.stage('preview'):
+					render_mosaic(image_data, tiles_data, image_title, slug_names, preview=True)
+				print('Wrote preview after {:.1f}s, refining it...'.format(profiler.stages['preview']['wall_seconds']))
+			compose(image_data, tiles_data, image_title, slug_names, profiler, result_cache)
 	else:
 		show_error("No images found in tiles directory '{}'".format(tiles_paths))
+	dump_cprofile(profile, PROFILE_REPORT_FILE, 'main')
 
 if __name__ == '__main__':
-	if len(sys.argv) < 4:
-		show_error('Usage: {} <image> <tiles directory>\r'.format(sys.argv[0]))
+	parser = argparse.ArgumentParser(description='Build a mosaic of an image out of the inscriptions of one or more collections')
+	parser.add_argument('image')
+	parser.add_argument('slugs', help='comma separated collection slugs, the tiles are read from images/<slug>')
+	parser.add_argument('title')
+	parser.add_argument('--tiles-per-row', type=int, default=NUM_TILES_PER_ROW)
+	parser.add_argument('--keep-aspect-ratio', action='store_true', default=KEEP_ASPECT_RATIO, help='as many rows as keep the aspect ratio of the image, instead of a square mosaic')
+	parser.add_argument('--tile-size', type=int, default=TILE_SIZE, help='height/width of the tiles in the jpeg, in pixels')
+	parser.add_argument('--match-res', type=int, default=TILE_MATCH_RES, help='tile matching resolution')
+	parser.add_argument('--match-features', choices=MATCH_FEATURES_MODES, default=MATCH_FEATURES, help='compare raw rgb pixels or low frequency CIELAB DCT coefficients')
+	parser.add_argument('--repeat', choices=REPEAT_MODES, default=REPEAT)
+	parser.add_argument('--max-occurrences', type=int, default=MAX_OCCURRENCES_PER_TILE, help='how often a tile can be repeated')
+	parser.add_argument('--seed', type=int, default=SEED, help='render the same mosaic for the same inputs every time')
+	parser.add_argument('--html-template', choices=HTML_TEMPLATES, default=HTML_TEMPLATE, help='an img for every cell, or one canvas that fetches every inscription once')
+	parser.add_argument('--canvas-memory-mb', type=int, default=CANVAS_MEMORY_MB, help='larger mosaics are assembled on disk and saved in several jpegs')
+	args = parser.parse_args()
+	source_image = args.image
+	slug_names = args.slugs.split(',')
+	tile_dir_list = ['images/' + slug for slug in slug_names]
+	# need to read them in same order that the inscription ids are
+	if not os.path.isfile(source_image):
+		show_error("Unable to find image file '{}'".format(source_image))
 	else:
-		source_image = sys.argv[1]
-		slug_names = sys.argv[2].split(',')
-		tile_dir_list = ['images/' + slug for slug in slug_names]
-		# need to read them in same order that the inscription ids are
-		image_title = sys.argv[3]
-		if not os.path.isfile(source_image):
-			show_error("Unable to find image file '{}'".format(source_image))
-		else:
-			mosaic(source_image, tile_dir_list, image_title, slug_names)
+		mosaic(source_image, tile_dir_list, args.title, slug_names, NUM_TILES_PER_ROW=args.tiles_per_row, KEEP_ASPECT_RATIO=args.keep_aspect_ratio,
+			TILE_SIZE=args.tile_size, TILE_MATCH_RES=args.match_res, MATCH_FEATURES=args.match_features, REPEAT=args.repeat, MAX_OCCURRENCES_PER_TILE=args.max_occurrences,
+			SEED=args.seed, CANVAS_MEMORY_MB=args.canvas_memory_mb, HTML_TEMPLATE=args.html_template)
 
 
@@ -0,0 +1,70 @@
+import cProfile
+import json
+import os
+import time
+from contextlib import contextmanager
+
+# Opt-in instrumentation for mosaic.py, see PROFILE in mosaic.py
+
+class StageProfiler:
+    # accumulates wall and cpu time per named stage of the current process
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start_wall, time.process_time() - start_cpu)
+
+    def add(self, name, wall_seconds, cpu_seconds, calls=1):
+        stage = self.stages.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'calls': 0})
+        stage['wall_seconds'] += wall_seconds
+        stage['cpu_seconds'] += cpu_seconds
+        stage['calls'] += calls
+
+    def merge(self, stages):
+        for name, stage in stages.items():
+            self.add(name, stage['wall_seconds'], stage['cpu_seconds'], stage['calls'])
+
+class QueueDepthSampler:
+    # records (seconds since start_time, queue size) at most every interval seconds
+    def __init__(self, queue, start_time, interval=0.1):
+        self.queue = queue
+        self.start_time = start_time
+        self.interval = interval
+        self.last_sample_time = 0
+        self.samples = []
+
+    def sample(self):
+        now = time.time()
+        if now - self.last_sample_time < self.interval:
+            return
+        self.last_sample_time = now
+        try:
+            self.samples.append((round(now - self.start_time, 3), self.queue.qsize()))
+        except NotImplementedError:
+            # multiprocessing queues can't report their size on macOS
+            pass
+
+def start_cprofile(enabled):
+    if not enabled:
+        return None
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+def dump_cprofile(profile, report_file, role):
+    # one .prof file per process, e.g. mosaic-profile-worker-1234.prof, readable with `python3 -m pstats`
+    if profile is None:
+        return
+    profile.disable()
+    profile.dump_stats('{}-{}-{}.prof'.format(os.path.splitext(report_file)[0], role, os.getpid()))
+
+def write_report(report_file, report):
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Wrote profile report to', report_file)
@@ -0,0 +1,210 @@
+import argparse
+import base64
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Pool
+from urllib.parse import parse_qs, urlparse
+from PIL import Image, UnidentifiedImageError
+import mosaic
+from batch import load_collection
+
+# Local rendering service that keeps the collections loaded between requests:
+#   python3 serve.py --port 8000
+#   curl --data-binary @cat.jpg 'http://127.0.0.1:8000/render?slugs=bitcoin-frogs&title=Cat&REPEAT=OK'
+# responds with json holding the stats, the inscribable html, the preview html and the base64 encoded jpeg (or jpegs). With
+# preview=1 it streams two json lines instead, first a quick mosaic matched on average colour only, then the full one
+
+COLLECTION_CACHE_MB = 512	# memory budget of the collections every worker keeps loaded
+# the mosaic.py settings a request can override, TILE_MATCH_RES and MATCH_FEATURES can't be as the collections are
+# kept processed with them
+SETTINGS = ('NUM_TILES_PER_ROW', 'KEEP_ASPECT_RATIO', 'RANDOM_RANGE', 'SEED', 'REPEAT', 'DIFF_RANDOM_VAR', 'CANDIDATE_COUNT', 'MAX_OCCURRENCES_PER_TILE',
+    'PLACEMENT', 'ASSIGNMENT_CANDIDATES', 'ASSIGNMENT_REPEAT_PENALTY', 'ASSIGNMENT_MAX_ROUNDS', 'ID_NUMS_ENCODING', 'HTML_TEMPLATE')
+
+class CollectionCache:
+    # the collections of this process, the least recently used ones are dropped once they take more than
+    # budget_bytes. The decoded large tiles of a collection count towards the budget as they get loaded
+    def __init__(self, budget_bytes):
+        self.budget_bytes = budget_bytes
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, slug_names):
+        # returns (tiles, tile features, large tiles)
+        key = ','.join(slug_names)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.hits += 1
+        else:
+            self.entries[key] = load_collection(slug_names) + ({},)
+            self.misses += 1
+        return self.entries[key]
+
+    def get_size(self, key):
+        tiles, tile_features, large_tiles = self.entries[key]
+        return tiles[1].nbytes + tiles[4].nbytes + tile_features.nbytes + sum(tile.nbytes for tile in large_tiles.values())
+
+    def evict(self):
+        # the most recently used collection always stays, even when it is over the budget on its own
+        sizes = {key: self.get_size(key) for key in self.entries}
+        total = sum(sizes.values())
+        while len(self.entries) > 1 and total > self.budget_bytes:
+            key, _ = self.entries.popitem(last=False)
+            total -= sizes[key]
+            print('Evicted collection {} from the cache'.format(key))
+
+cache = None
+
+def init_worker(budget_bytes, preload_slugs):
+    global cache
+    cache = CollectionCache(budget_bytes)
+    for slug_names in preload_slugs:
+        cache.get(slug_names)
+    cache.evict()
+
+def render_request(image_bytes, slug_names, image_title, settings, preview=False):
+    # runs in a pool worker, which only ever renders one request at a time so the settings can be set on the module
+    defaults = {name: getattr(mosaic, name) for name in settings}
+    output_dir = tempfile.mkdtemp(prefix='mosaic-')
+    try:
+        mosaic.configure(**settings)
+        hits = cache.hits
+        tiles, tile_features, large_tiles = cache.get(slug_names)
+        image_data = mosaic.TargetImage(io.BytesIO(image_bytes)).get_data()
+        result_cache = mosaic.get_result_cache(image_bytes, slug_names)
+        stats = mosaic.render_mosaic(image_data, tiles, image_title, slug_names, output_dir, large_tiles, preview, tile_features, result_cache)
+        stats['collection_cached'] = cache.hits > hits
+        jpegs = []
+        for jpeg_file in stats.pop('jpeg_files'):
+            with open(jpeg_file, 'rb') as f:
+                jpegs.append(f.read())
+        with open(os.path.join(output_dir, mosaic.HTML_OUT_FILE)) as f:
+            html = f.read()
+        with open(os.path.join(output_dir, mosaic.PREVIEW_HTML_OUT_FILE)) as f:
+            preview_html = f.read()
+    finally:
+        mosaic.configure(**defaults)
+        shutil.rmtree(output_dir)
+        cache.evict()
+    return {'stats': stats, 'jpegs': jpegs, 'html': html, 'preview_html': preview_html}
+
+def parse_slugs(value):
+    slug_names = value.split(',')
+    for slug in slug_names:
+        if not re.match(r'^[\w-]+$', slug) or not os.path.isdir('images/' + slug):
+            raise ValueError("Unknown collection '{}'".format(slug))
+    return slug_names
+
+def parse_render_params(params):
+    # returns (slug names, title, settings, preview) from the query string of a render request
+    if 'slugs' not in params:
+        raise ValueError('Missing slugs')
+    slug_names = parse_slugs(params['slugs'][0])
+    image_title = params.get('title', ['Mosaic'])[0]
+    preview = params.get('preview', ['0'])[0] == '1'
+    settings = {}
+    for name, values in params.items():
+        if name in ('slugs', 'title', 'preview'):
+            continue
+        if name not in SETTINGS:
+            raise ValueError("Unknown setting '{}'".format(name))
+        value = values[0]
+        # SEED is the only one that defaults to None
+        if getattr(mosaic, name) is None or isinstance(getattr(mosaic, name), (int, float)):
+            value = float(value)
+            value = int(value) if value.is_integer() else value
+        settings[name] = value
+    return (slug_names, image_title, settings, preview)
+
+class RenderHandler(BaseHTTPRequestHandler):
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self.send_json(200, {'status': 'ok', 'workers': self.server.worker_count})
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/render':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        image_bytes = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            slug_names, image_title, settings, preview = parse_render_params(parse_qs(url.query))
+            if not image_bytes:
+                raise ValueError('Missing image')
+        except ValueError as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        render_args = (image_bytes, slug_names, image_title, settings)
+        if not preview:
+            self.send_json(*self.render(render_args, False))
+            return
+        # one json line per pass, the connection closes after the last one
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        for preview_pass in (True, False):
+            status, body = self.render(render_args, preview_pass)
+            self.wfile.write(json.dumps(body).encode() + b'\n')
+            self.wfile.flush()
+            if status != 200:
+                break
+
+    def render(self, render_args, preview):
+        # returns (status, body)
+        start_time = time.time()
+        try:
+            # the handler threads share the pool, each request blocks its own thread until a worker is done with it
+            result = self.server.pool.apply(render_request, render_args + (preview,))
+        except ValueError as e:
+            return (400, {'error': str(e)})
+        except UnidentifiedImageError:
+            return (400, {'error': 'Unable to read the image'})
+        except Image.DecompressionBombError as e:
+            return (400, {'error': str(e)})
+        except Exception as e:
+            return (500, {'error': '{}: {}'.format(type(e).__name__, e)})
+        result['stats']['seconds'] = round(time.time() - start_time, 3)
+        result['stats']['preview'] = preview
+        # mosaics over CANVAS_MEMORY_MB are saved as several jpegs of rows, top to bottom
+        result['jpegs'] = [base64.b64encode(jpeg).decode() for jpeg in result['jpegs']]
+        if len(result['jpegs']) == 1:
+            result['jpeg'] = result.pop('jpegs')[0]
+        return (200, result)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve mosaic renders over http, keeping the collections loaded between requests')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=mosaic.WORKER_COUNT, help='how many mosaics are rendered at once')
+    parser.add_argument('--cache-mb', type=int, default=COLLECTION_CACHE_MB, help='memory budget of the collections every worker keeps loaded')
+    parser.add_argument('--preload', default='', help='comma separated slugs every worker loads at startup')
+    args = parser.parse_args()
+
+    preload_slugs = [[slug] for slug in parse_slugs(args.preload)] if args.preload else []
+    server = ThreadingHTTPServer((args.host, args.port), RenderHandler)
+    server.worker_count = args.workers
+    with Pool(args.workers, initializer=init_worker, initargs=(args.cache_mb * 1024 * 1024, preload_slugs)) as server.pool:
+        print('Serving on http://{}:{}/render'.format(args.host, args.port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,110 @@
+import importlib.util
+import io
+import json
+import os
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from PIL import Image
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def get_png(color):
+    data = io.BytesIO()
+    Image.new('RGB', (8, 8), color).save(data, 'PNG')
+    return data.getvalue()
+
+# what the stand-in server holds, by inscription id. Every id fails the way its name says before it's served
+COLORS = {
+    'ok0': (200, 10, 10),
+    'ok1': (10, 200, 10),
+    'busy0': (10, 10, 200),
+    'busy1': (120, 120, 0),
+    'truncated0': (0, 120, 120),
+}
+CONTENTS = dict({id: get_png(color) for id, color in COLORS.items()}, undecodable0=b'not an image')
+FAILED_IDS = ['missing0', 'undecodable0']
+
+class ContentHandler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        self.respond(False)
+
+    def do_GET(self):
+        self.respond(True)
+
+    def respond(self, send_body):
+        id = self.path.rsplit('/', 1)[1]
+        with self.server.lock:
+            self.server.requests.append((self.command, id))
+            attempt = self.server.attempts[id]
+            self.server.attempts[id] += 1
+        if id not in CONTENTS:
+            self.send_error(404)
+        elif id.startswith('busy') and attempt < 2:
+            self.send_error(503)
+        elif id.startswith('truncated') and attempt < 1 and send_body:
+            # promises the whole file but stops half way
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(CONTENTS[id])))
+            self.end_headers()
+            self.wfile.write(CONTENTS[id][:len(CONTENTS[id]) // 2])
+            self.close_connection = True
+        else:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(CONTENTS[id])))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(CONTENTS[id])
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ContentHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    server.attempts = Counter()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def downloader(server, tmp_path, monkeypatch):
+    # the script creates images/ in the working directory when it's loaded, and points at CONTENT_BASE_URL
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('CONTENT_BASE_URL', 'http://127.0.0.1:{}/content/'.format(server.server_address[1]))
+    spec = importlib.util.spec_from_file_location('download_inscriptions', os.path.join(REPO_DIR, 'download-inscriptions.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.DOWNLOAD_BACKOFF_SECONDS = 0.01
+    module.DOWNLOAD_TIMEOUT_SECONDS = 5
+    os.makedirs('images/test')
+    return module
+
+def test_download_all(downloader, server):
+    ids = sorted(CONTENTS) + ['missing0']
+    failed_ids = downloader.download_all_inscription_content('test', ids, 'images/test')
+    assert sorted(failed_ids) == FAILED_IDS
+    with open('images/test-manifest.json') as f:
+        manifest = json.load(f)
+    assert manifest == {id: {'bytes': len(CONTENTS[id]), 'color': list(color)} for id, color in COLORS.items()}
+    for id in COLORS:
+        with open('images/test/' + id, 'rb') as f:
+            assert f.read() == CONTENTS[id]
+    assert os.listdir('images/.partial') == []
+    # the server errors were retried, the 404 wasn't
+    assert server.attempts['busy0'] == 3
+    assert server.attempts['truncated0'] == 2
+    assert server.attempts['missing0'] == 1
+
+    # a second run only goes back to the server for the ids that failed
+    del server.requests[:]
+    failed_ids = downloader.download_all_inscription_content('test', ids, 'images/test')
+    assert sorted(failed_ids) == FAILED_IDS
+    assert {id for _, id in server.requests} == set(FAILED_IDS)
+    with open('images/test-manifest.json') as f:
+        assert json.load(f) == manifest
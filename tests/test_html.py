@@ -0,0 +1,27 @@
+import re
+import shutil
+import subprocess
+import pytest
+import mosaic
+
+def get_inline_scripts(html):
+    return re.findall(r'<script>(.*?)</script>', html, re.S)
+
+def test_canvas_runtime_is_not_larger():
+    # the canvas template is only worth offering if its runtime fits in the bytes the dom one takes
+    assert mosaic.get_html_runtime_bytes('canvas') <= mosaic.get_html_runtime_bytes('dom')
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='needs node')
+@pytest.mark.parametrize('template', mosaic.HTML_TEMPLATES)
+@pytest.mark.parametrize('encoding', mosaic.ID_NUMS_ENCODINGS)
+def test_inline_script_parses(template, encoding, tmp_path):
+    id_nums_str = mosaic.encode_id_nums([3, -1, 0, 2, 1, -1], encoding)
+    id_nums_decoder_str = mosaic.ID_NUMS_DECODER_JS if encoding != 'json' else ''
+    html = mosaic.get_html('', id_nums_str, id_nums_decoder_str, 'https://ordinals.com', 'title', template)
+    scripts = get_inline_scripts(html)
+    assert scripts
+    for i, script in enumerate(scripts):
+        script_path = tmp_path / 'script{}.js'.format(i)
+        script_path.write_text(script)
+        result = subprocess.run(['node', '--check', str(script_path)], capture_output=True, text=True)
+        assert result.returncode == 0, result.stderr
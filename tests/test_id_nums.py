@@ -0,0 +1,38 @@
+import json
+import random
+import shutil
+import subprocess
+import pytest
+import mosaic
+
+INPUTS = {
+    'random': [random.Random(0).randrange(10000) for _ in range(10000)],
+    'sequential': list(range(10000)),
+    'over 16 bits': [random.Random(1).randrange(2 ** 24) for _ in range(1000)] + [2 ** 16, 2 ** 16 - 1, 0],
+    'empty': [],
+    # cells no tile could be placed in
+    'with empty cells': [5, -1, 300, -1, -1, 0, 255],
+    'empty cell at the width limit': [254, -1, 253],
+}
+
+@pytest.mark.parametrize('encoding', mosaic.ID_NUMS_ENCODINGS)
+@pytest.mark.parametrize('name', INPUTS)
+def test_round_trip(encoding, name):
+    assert mosaic.decode_id_nums(mosaic.encode_id_nums(INPUTS[name], encoding)) == INPUTS[name]
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        mosaic.encode_id_nums([1, 2], 'base32')
+
+def test_encoding_sizes_of_empty_mosaic():
+    assert set(mosaic.get_id_nums_encoding_sizes([])) == set(mosaic.ID_NUMS_ENCODINGS)
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='needs node')
+@pytest.mark.parametrize('encoding', mosaic.ID_NUMS_ENCODINGS)
+def test_javascript_decoder(encoding):
+    # the html decodes orderedIdNums with ID_NUMS_DECODER_JS, it has to agree with decode_id_nums
+    expressions = {name: mosaic.encode_id_nums(ordered_id_nums, encoding) for name, ordered_id_nums in INPUTS.items()}
+    script = mosaic.ID_NUMS_DECODER_JS + 'console.log(JSON.stringify({' + ','.join(
+        '{}: {}'.format(json.dumps(name), expression) for name, expression in expressions.items()) + '}))'
+    output = subprocess.run(['node', '-e', script], capture_output=True, text=True, check=True).stdout
+    assert json.loads(output) == INPUTS
@@ -0,0 +1,78 @@
+import io
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+import numpy as np
+import pytest
+from PIL import Image
+import mosaic
+import serve
+from benchmark import make_synthetic_collection, make_synthetic_target
+
+def get_collection(num_bytes):
+    # what load_collection returns, as far as CollectionCache.get_size looks at it
+    return ((None, np.zeros(num_bytes, dtype=np.uint8), None, None, np.zeros(0)), np.zeros(0))
+
+def test_evict_least_recently_used(monkeypatch):
+    monkeypatch.setattr(serve, 'load_collection', lambda slug_names: get_collection(100))
+    cache = serve.CollectionCache(250)
+    cache.get(['a'])
+    cache.get(['b'])
+    cache.get(['a'])
+    cache.get(['c'])
+    cache.evict()
+    assert list(cache.entries) == ['a', 'c']
+    assert (cache.hits, cache.misses) == (1, 3)
+
+def test_evict_keeps_the_most_recent(monkeypatch):
+    monkeypatch.setattr(serve, 'load_collection', lambda slug_names: get_collection(100))
+    cache = serve.CollectionCache(50)
+    cache.get(['a'])
+    cache.get(['b', 'c'])
+    cache.evict()
+    assert list(cache.entries) == ['b,c']
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # a tiny collection and a target, in a directory of their own since everything is read relative to it
+    monkeypatch.chdir(tmp_path)
+    make_synthetic_collection('tiny', 40)
+    with open(make_synthetic_target('target.jpeg', 120, 90), 'rb') as f:
+        return f.read()
+
+@pytest.fixture
+def server(workdir):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), serve.RenderHandler)
+    server.worker_count = 1
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.mark.parametrize('query', ['slugs=tiny&NUM_TILES_PER_ROW=ten', 'slugs=tiny&TILE_MATCH_RES=8', 'slugs=missing', 'title=Cat'])
+def test_bad_request(server, workdir, query):
+    # these are all rejected before a worker is asked to render
+    request = urllib.request.Request('http://127.0.0.1:{}/render?{}'.format(server.server_address[1], query), data=workdir)
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(request)
+    assert error.value.code == 400
+
+def test_render_request(workdir, monkeypatch):
+    monkeypatch.setattr(serve, 'cache', None)
+    serve.init_worker(1024 * 1024, [['tiny']])
+    settings = {'NUM_TILES_PER_ROW': 10, 'REPEAT': 'OK', 'SEED': 1}
+    defaults = {name: getattr(mosaic, name) for name in settings}
+    result = serve.render_request(workdir, ['tiny'], 'Tiny', settings)
+    stats = result['stats']
+    assert stats['collection_cached']
+    assert stats['empty_cells'] == 0
+    assert 'const SIZE=10' in result['html'] and '<title>Tiny</title>' in result['html']
+    assert len(result['jpegs']) == 1
+    assert Image.open(io.BytesIO(result['jpegs'][0])).size == (10 * mosaic.TILE_SIZE, 10 * mosaic.TILE_SIZE)
+    # the request's settings don't stay behind for the next one
+    assert {name: getattr(mosaic, name) for name in settings} == defaults
+
+    # the same seed gives the same mosaic
+    assert serve.render_request(workdir, ['tiny'], 'Tiny', settings)['html'] == result['html']
@@ -0,0 +1,69 @@
+import sys
+import numpy as np
+import pytest
+import mosaic
+
+class ReferenceTileFitter:
+    # the tile by tile scan TileFitter replaced, kept as it was apart from holding the usage counts itself instead
+    # of in globals
+    def __init__(self, tiles_data):
+        self.tiles_data = tiles_data
+        self.used_tile_data_index_counts = {}
+        self.all_have_been_included = False
+
+    def get_tile_diff(self, t1, t2, bail_out_value):
+        diff = 0
+        for i in range(len(t1)):
+            diff += (t1[i][0] - t2[i][0]) ** 2 + (t1[i][1] - t2[i][1]) ** 2 + (t1[i][2] - t2[i][2]) ** 2
+            if diff > bail_out_value:
+                # we know already that this isn't going to be the best fit, so no point continuing with this tile
+                return diff
+        return diff
+
+    def should_skip(self, tile_index):
+        if tile_index not in self.used_tile_data_index_counts:
+            return False
+        if mosaic.REPEAT in ['STRICT_NO', 'MINIMIZED'] or (mosaic.REPEAT == 'ALL_INCLUDED' and not self.all_have_been_included):
+            return True
+        return self.used_tile_data_index_counts[tile_index] >= mosaic.MAX_OCCURRENCES_PER_TILE
+
+    def get_best_fit_tile(self, img_data):
+        best_fit_tile_index = None
+        min_diff = sys.maxsize
+        if len(self.used_tile_data_index_counts) == len(self.tiles_data):
+            self.all_have_been_included = True
+        for tile_index in range(len(self.tiles_data)):
+            if self.should_skip(tile_index):
+                continue
+            diff = self.get_tile_diff(img_data, self.tiles_data[tile_index], min_diff)
+            if diff < min_diff:
+                min_diff = diff
+                best_fit_tile_index = tile_index
+        # once every tile is used up this counts None as one more tile, which keeps all_have_been_included as it was
+        self.used_tile_data_index_counts[best_fit_tile_index] = self.used_tile_data_index_counts.get(best_fit_tile_index, 0) + 1
+        return best_fit_tile_index
+
+def get_case(seed, num_tiles=30, num_cells=90, pixels=16):
+    # few distinct values so that many cells are as close to several tiles, and some tiles appear twice
+    rng = np.random.default_rng(seed)
+    tiles = rng.integers(0, 4, (num_tiles, pixels, 3))
+    tiles[rng.choice(num_tiles, num_tiles // 5, replace=False)] = tiles[rng.choice(num_tiles, num_tiles // 5, replace=False)]
+    cells = rng.integers(0, 4, (num_cells, pixels, 3))
+    return (tiles, cells)
+
+@pytest.mark.parametrize('repeat', mosaic.REPEAT_MODES)
+@pytest.mark.parametrize('seed', range(4))
+def test_same_tiles_as_reference(repeat, seed, monkeypatch):
+    # more cells than the tiles can fill, so the picks run into every usage rule
+    monkeypatch.setattr(mosaic, 'REPEAT', repeat)
+    monkeypatch.setattr(mosaic, 'MAX_OCCURRENCES_PER_TILE', 2)
+    tiles, cells = get_case(seed)
+    reference = ReferenceTileFitter(tiles.tolist())
+    expected = [reference.get_best_fit_tile(cell) for cell in cells.tolist()]
+
+    tile_fitter = mosaic.TileFitter(tiles, np.zeros(len(tiles), dtype=np.int64))
+    tile_fitter.seed(0)
+    picked = []
+    for i in range(0, len(cells), mosaic.MATCH_BLOCK_SIZE):
+        picked += tile_fitter.get_best_fit_tiles(cells[i:i + mosaic.MATCH_BLOCK_SIZE])
+    assert picked == expected
@@ -0,0 +1,190 @@
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+from collections import Counter
+import numpy as np
+from mosaic import CACHE_DIR, decode_id_nums
+
+# Checks generated mosaics against the rules in the README and reports their stats, without loading any images:
+#   python3 validate-mosaic.py mosaic.html candidates/
+# Directories are searched for .html files. The tiles are resolved through the ids files the mosaic loads, found by
+# their inscription id in collections/*/info.json, and the download bytes come from the sizes recorded when the
+# tiles were downloaded or cached
+
+GRID_SIZE = 100	# tiles per row and per column
+MAX_OCCURRENCES = 20	# times a single tile can appear
+MIN_UNIQUE_TILES = 500
+
+class Collections:
+    # the ids and tile file sizes of the collections in collections/, each read once however many mosaics use it
+    def __init__(self):
+        # inscription id of every ids file -> (slug, path of the ids file)
+        self.ids_files = {}
+        for info_path in glob.glob('collections/*/info.json'):
+            slug = os.path.basename(os.path.dirname(info_path))
+            with open(info_path) as f:
+                info = json.load(f)
+            for name, inscription_id in info.items():
+                if re.match(r'^ids\d+$', name):
+                    self.ids_files[inscription_id] = (slug, os.path.join(os.path.dirname(info_path), name + '.js'))
+        self.ids = {}
+        self.file_sizes = {}
+
+    def get_ids(self, inscription_id):
+        # returns (slug, ids) of the ids file inscribed as inscription_id, or None if it isn't one of ours
+        if inscription_id not in self.ids_files:
+            return None
+        slug, path = self.ids_files[inscription_id]
+        if path not in self.ids:
+            with open(path) as f:
+                self.ids[path] = json.loads(f.read().split('=', 1)[1])
+        return (slug, self.ids[path])
+
+    def get_file_sizes(self, slug):
+        # file size by inscription id, from the download manifest, then the tile caches, then the files themselves
+        if slug in self.file_sizes:
+            return self.file_sizes[slug]
+        file_sizes = {}
+        for tile_cache_path in glob.glob(os.path.join(CACHE_DIR, slug, 'tiles-*.npz')):
+            try:
+                with np.load(tile_cache_path) as data:
+                    file_sizes.update(zip(data['names'].tolist(), data['file_sizes'].tolist()))
+            except Exception as e:
+                print('Ignoring unreadable tile cache {}: {}'.format(tile_cache_path, e))
+        manifest_path = 'images/{}-manifest.json'.format(slug)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as f:
+                file_sizes.update((inscription_id, entry['bytes']) for inscription_id, entry in json.load(f).items())
+        self.file_sizes[slug] = file_sizes
+        return file_sizes
+
+    def get_file_size(self, slug, inscription_id):
+        file_sizes = self.get_file_sizes(slug)
+        if inscription_id not in file_sizes:
+            tile_path = os.path.join('images', slug, inscription_id)
+            file_sizes[inscription_id] = os.path.getsize(tile_path) if os.path.isfile(tile_path) else None
+        return file_sizes[inscription_id]
+
+def parse_mosaic(html):
+    # returns (title, tiles per row, orderedIdNums, inscription ids of the loaded scripts) of a generated mosaic
+    title = re.search(r'<title>(.*?)</title>', html, re.S)
+    size = re.search(r'const SIZE=(\d+)', html)
+    id_nums = re.search(r'const orderedIdNums = (.*)', html)
+    if size is None or id_nums is None:
+        raise ValueError('Not a generated mosaic')
+    script_ids = re.findall(r'<script src="[^"]*/content/([^"/]+)"></script>', html)
+    return (title.group(1) if title else '', int(size.group(1)), decode_id_nums(id_nums.group(1)), script_ids)
+
+def validate_mosaic(path, collections):
+    # returns the report of one mosaic, its errors being the rules it breaks
+    with open(path) as f:
+        title, size, ordered_id_nums, script_ids = parse_mosaic(f.read())
+    errors = []
+    # inscriptionIds in the mosaic is the concatenation of the ids files in the order they are loaded
+    slugs = []
+    tile_slugs = []
+    inscription_ids = []
+    for script_id in script_ids:
+        ids_file = collections.get_ids(script_id)
+        if ids_file is None:
+            # colors files, or ids files of collections that aren't in collections/
+            continue
+        slug, ids = ids_file
+        if slug not in slugs:
+            slugs.append(slug)
+        tile_slugs += [slug] * len(ids)
+        inscription_ids += ids
+    if not inscription_ids:
+        errors.append('no known ids files are loaded')
+
+    # -1 marks the cells no tile could be placed in
+    counts = Counter(id_num for id_num in ordered_id_nums if id_num >= 0)
+    empty_cells = len(ordered_id_nums) - sum(counts.values())
+    unknown = [id_num for id_num in counts if not 0 <= id_num < len(inscription_ids)]
+    if inscription_ids and unknown:
+        errors.append('{} tile numbers are past the {} loaded ids'.format(len(unknown), len(inscription_ids)))
+    download_bytes = 0
+    unknown_sizes = 0
+    for id_num in counts:
+        if 0 <= id_num < len(inscription_ids):
+            file_size = collections.get_file_size(tile_slugs[id_num], inscription_ids[id_num])
+            if file_size is None:
+                unknown_sizes += 1
+            else:
+                download_bytes += file_size
+
+    rows = -(-len(ordered_id_nums) // size)
+    max_occurrences = max(counts.values(), default=0)
+    if size != GRID_SIZE or len(ordered_id_nums) != GRID_SIZE * GRID_SIZE:
+        errors.append('{} tiles in rows of {}, not {}x{}'.format(len(ordered_id_nums), size, GRID_SIZE, GRID_SIZE))
+    if empty_cells:
+        errors.append('{} cells have no tile'.format(empty_cells))
+    if max_occurrences > MAX_OCCURRENCES:
+        overused = sum(1 for count in counts.values() if count > MAX_OCCURRENCES)
+        errors.append('{} tiles appear more than {} times, up to {}'.format(overused, MAX_OCCURRENCES, max_occurrences))
+    if len(counts) < MIN_UNIQUE_TILES:
+        errors.append('{} unique tiles, less than {}'.format(len(counts), MIN_UNIQUE_TILES))
+    return {
+        'path': path,
+        'title': title,
+        'collections': slugs,
+        'grid': [size, rows],
+        'cells': len(ordered_id_nums),
+        'empty_cells': empty_cells,
+        'unique_tiles': len(counts),
+        'max_occurrences': max_occurrences,
+        # number of tiles by how many times they appear
+        'occurrences': dict(sorted(Counter(counts.values()).items())),
+        'download_bytes': download_bytes,
+        'unknown_sizes': unknown_sizes,
+        'errors': errors,
+        'valid': not errors,
+    }
+
+def find_mosaics(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            yield from sorted(glob.glob(os.path.join(path, '**', '*.html'), recursive=True))
+        else:
+            yield path
+
+def print_report(report):
+    print('{} {} "{}"'.format('OK  ' if report['valid'] else 'FAIL', report['path'], report['title']))
+    print('    {} cells ({}x{}) from {}, {} unique tiles, at most {} times each, {} download bytes{}'.format(
+        report['cells'], report['grid'][0], report['grid'][1], ','.join(report['collections']) or '-', report['unique_tiles'],
+        report['max_occurrences'], report['download_bytes'],
+        ' ({} tile sizes unknown)'.format(report['unknown_sizes']) if report['unknown_sizes'] else ''))
+    print('    tiles by occurrences: ' + ', '.join('{}x {}'.format(occurrences, tiles) for occurrences, tiles in report['occurrences'].items()))
+    for error in report['errors']:
+        print('    - ' + error)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check generated mosaics against the rules and report their stats')
+    parser.add_argument('paths', nargs='+', help='mosaic html files, or directories to search for them')
+    parser.add_argument('--grid-size', type=int, default=GRID_SIZE, help='tiles per row and per column')
+    parser.add_argument('--max-occurrences', type=int, default=MAX_OCCURRENCES, help='times a single tile can appear')
+    parser.add_argument('--min-unique', type=int, default=MIN_UNIQUE_TILES, help='least number of unique tiles')
+    parser.add_argument('--json', help='also write every report to this file')
+    args = parser.parse_args()
+    GRID_SIZE, MAX_OCCURRENCES, MIN_UNIQUE_TILES = args.grid_size, args.max_occurrences, args.min_unique
+
+    collections = Collections()
+    reports = []
+    for path in find_mosaics(args.paths):
+        try:
+            report = validate_mosaic(path, collections)
+        except (OSError, ValueError) as e:
+            report = {'path': path, 'errors': [str(e)], 'valid': False}
+            print('FAIL {}\n    - {}'.format(path, e))
+        else:
+            print_report(report)
+        reports.append(report)
+    num_valid = sum(1 for report in reports if report['valid'])
+    print('{} of {} mosaics are valid'.format(num_valid, len(reports)))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=1)
+    sys.exit(0 if reports and num_valid == len(reports) else 1)